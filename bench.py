@@ -0,0 +1,762 @@
+#!/usr/bin/env python3.10
+"""bench - an offline load test for sandwich; no discord token required.
+
+synthetic messages are fed through `Sandwich.on_message`, with
+discord's http api replaced by an in-memory stand-in, and openai & the
+github archive endpoint served by a local aiohttp app. reports the
+throughput, per-command latency & memory growth of the run.
+
+with --memory, instead compares the memory used by lean & default gateway
+modes (see main.gateway_options), by feeding synthetic guilds & messages
+through discord.py's gateway event parsers.
+
+with --shards, instead runs the shard supervisor (see shards.py) against a
+local fake of discord's gateway & rest api; it measures the throughput of
+the shard processes, then kills one & waits for it to be restarted.
+
+usage: python bench.py [--messages N] [--concurrency N] [--api-latency S]
+       python bench.py --memory [--guilds N] [--messages N]
+       python bench.py --shards N [--processes N] [--messages N]
+"""
+import argparse
+import asyncio
+import io
+import itertools
+import os
+import random
+import signal
+import statistics
+import subprocess
+import sys
+import time
+import types
+import zipfile
+from typing import Optional
+
+import discord
+import orjson
+from aiohttp import web
+
+try:
+    import config
+except ImportError:  # no bot config; we don't need a token anyway
+    config = types.ModuleType("config")
+    sys.modules["config"] = config
+
+import main as sandwich
+import shards
+
+OWNER_ID = 285190493703503872  # whitelisted for everything
+BOT_ID = 1
+
+# (weight, content) of the messages we'll send
+WORKLOAD = (
+    (60, "just some regular chatter, nothing to see here"),
+    (10, "!how"),
+    (10, "!g python asyncio gather"),
+    (5, "!askai write a haiku about sandwiches"),
+    (3, "!genimage a sandwich, in space"),
+    (5, "!py\n```py\nreturn sum(range(10_000))```"),
+    (2, "!py\n```py\nprint(ctx.author.id)```"),  # runs in-process
+    (2, "!dis\n```py\ndef func(x):\n    return x * 2```"),
+    (3, "!gitlines cmyui/sandwich py"),
+)
+
+
+# local stand-ins for openai & github
+
+
+def make_archive() -> bytes:
+    """A zip of this repo's python files, laid out like a github archive."""
+    here = os.path.dirname(os.path.realpath(__file__))
+
+    with io.BytesIO() as f:
+        with zipfile.ZipFile(f, "w") as archive:
+            for filename in sorted(os.listdir(here)):
+                if filename.endswith(".py"):
+                    archive.write(
+                        os.path.join(here, filename),
+                        f"sandwich-master/{filename}",
+                    )
+
+        return f.getvalue()
+
+
+def make_api(latency: float) -> web.Application:
+    archive = make_archive()
+    etag = '"bench"'
+
+    async def completions(request: web.Request) -> web.StreamResponse:
+        payload = await request.json(loads=orjson.loads)
+        words = ["\n\n"] + ["sandwich "] * 32
+        await asyncio.sleep(latency)
+
+        if not payload.get("stream"):
+            return web.json_response(
+                {
+                    "choices": [{"text": "".join(words)}],
+                    "usage": {"total_tokens": len(words) + 8},
+                },
+                dumps=lambda x: orjson.dumps(x).decode(),
+            )
+
+        resp = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await resp.prepare(request)
+
+        for word in words:
+            event = orjson.dumps({"choices": [{"text": word}]})
+            await resp.write(b"data: " + event + b"\n\n")
+
+        await resp.write(b"data: [DONE]\n\n")
+        return resp
+
+    async def images(request: web.Request) -> web.Response:
+        await asyncio.sleep(latency)
+        return web.json_response({"data": [{"url": "https://example.com/a.png"}]})
+
+    async def github_archive(request: web.Request) -> web.Response:
+        await asyncio.sleep(latency)
+
+        if request.headers.get("If-None-Match") == etag:
+            return web.Response(status=304)
+
+        return web.Response(
+            body=archive,
+            content_type="application/zip",
+            headers={"ETag": etag},
+        )
+
+    app = web.Application()
+    app.router.add_post("/v1/completions", completions)
+    app.router.add_post("/v1/images/generations", images)
+    app.router.add_get("/{owner}/{repo}/archive/{branch}.zip", github_archive)
+    return app
+
+
+# a stand-in for discord's http api
+
+
+def user_data(user_id: int, name: str) -> dict[str, object]:
+    return {
+        "id": user_id,
+        "username": name,
+        "discriminator": "0001",
+        "avatar": None,
+    }
+
+
+def message_data(
+    msg_id: int,
+    channel_id: int,
+    author: dict[str, object],
+    content: Optional[str],
+) -> dict[str, object]:
+    return {
+        "id": msg_id,
+        "channel_id": channel_id,
+        "author": author,
+        "content": content or "",
+        "attachments": [],
+        "embeds": [],
+        "mentions": [],
+        "mention_roles": [],
+        "mention_everyone": False,
+        "pinned": False,
+        "tts": False,
+        "type": 0,
+        "edited_timestamp": None,
+    }
+
+
+class FakeDiscordHTTP:
+    """Just enough of `discord.http.HTTPClient` for our commands to run."""
+
+    def __init__(self) -> None:
+        self.ids = itertools.count(10**17)
+        self.requests = 0
+
+        self.messages: dict[int, dict[str, object]] = {}
+        self.bot_user = user_data(BOT_ID, "sandwich")
+
+    async def send_message(self, channel_id, content, **kwargs) -> dict:
+        self.requests += 1
+
+        data = message_data(next(self.ids), channel_id, self.bot_user, content)
+        self.messages[data["id"]] = data
+        return data
+
+    async def send_files(self, channel_id, *, files, content=None, **kwargs) -> dict:
+        return await self.send_message(channel_id, content)
+
+    async def edit_message(self, channel_id, message_id, **fields) -> dict:
+        self.requests += 1
+
+        data = self.messages[message_id]
+        data["content"] = fields.get("content") or data["content"]
+        return data
+
+    async def delete_message(self, channel_id, message_id, **kwargs) -> None:
+        self.requests += 1
+        self.messages.pop(message_id, None)
+
+    async def add_reaction(self, channel_id, message_id, emoji) -> None:
+        self.requests += 1
+
+    async def clear_reactions(self, channel_id, message_id) -> None:
+        self.requests += 1
+
+
+# the load test itself
+
+
+def rss() -> int:
+    """The process' current resident set size, in bytes."""
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+
+
+def percentile(samples: list[float], p: int) -> float:
+    if len(samples) < 2:
+        return samples[0] if samples else 0.0
+
+    return statistics.quantiles(samples, n=100, method="inclusive")[p - 1]
+
+
+async def run(args: argparse.Namespace) -> None:
+    runner = web.AppRunner(make_api(args.api_latency))
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    host, port = runner.addresses[0][:2]
+
+    config.openai_base_url = f"http://{host}:{port}/v1"
+    config.github_url = f"http://{host}:{port}"
+    config.gitlines_cache_path = os.path.join(args.data_dir, "gitlines.json")
+    config.state_path = os.path.join(args.data_dir, "state.pickle")
+    config.askai_edit_interval = 0.01
+
+    # everything's sent by one user; keep the pools, but not the rate limits
+    config.heavy_commands = {
+        name: (concurrency, 10**9, 1.0)
+        for name, (concurrency, _, _) in sandwich.HEAVY_COMMANDS.items()
+    }
+
+    bot = sandwich.Sandwich(command_prefix="!", help_command=None)
+    bot.owner_id = OWNER_ID
+
+    fake_http = FakeDiscordHTTP()
+    state = bot._connection
+    state.http = fake_http
+    state.user = discord.ClientUser(state=state, data=fake_http.bot_user)
+
+    author = user_data(OWNER_ID, "cmyui")
+    channel = discord.DMChannel(
+        me=state.user,
+        state=state,
+        data={"id": 2, "recipients": [author]},
+    )
+
+    await bot.setup()
+
+    rng = random.Random(args.seed)
+    weights, contents = zip(*WORKLOAD)
+    msg_ids = itertools.count(10**16)
+
+    # per command (or "filtered") latencies, in seconds
+    latencies: dict[str, list[float]] = {}
+
+    async def send(content: str) -> None:
+        data = message_data(next(msg_ids), channel.id, author, content)
+        msg = discord.Message(state=state, channel=channel, data=data)
+
+        start = time.perf_counter()
+        await bot.on_message(msg)
+
+        # commands are run in a task of their own; wait for it
+        if (task := bot.invocations.tasks.get(msg.id)) is not None:
+            await task
+
+        elapsed = time.perf_counter() - start
+
+        if content.startswith("!"):
+            name = content[1:].split(maxsplit=1)[0]
+        else:
+            name = "(filtered)"
+
+        latencies.setdefault(name, []).append(elapsed)
+
+    async def load(n: int) -> float:
+        queue = rng.choices(contents, weights, k=n)
+
+        async def worker() -> None:
+            while queue:
+                await send(queue.pop())
+
+        start = time.perf_counter()
+        await asyncio.gather(*[worker() for _ in range(args.concurrency)])
+        return time.perf_counter() - start
+
+    try:
+        # let caches, workers & lazy imports warm up first
+        await load(args.warmup)
+        latencies.clear()
+        bot.metrics.commands.clear()
+
+        rss_before = rss()
+        elapsed = await load(args.messages)
+        rss_after = rss()
+    finally:
+        await bot.teardown()
+        await runner.cleanup()
+
+    print(
+        f"{args.messages:,} messages in {elapsed:.2f}s "
+        f"({args.messages / elapsed:,.1f} msgs/sec, "
+        f"concurrency {args.concurrency}, "
+        f"{fake_http.requests:,} discord requests)",
+    )
+    print()
+    print(f"{'command':<12} {'count':>6} {'errs':>5} {'p50':>10} {'p99':>10}")
+
+    for name, samples in sorted(latencies.items()):
+        if (stats := bot.metrics.commands.get(name)) is not None:
+            errors = stats.errors
+        else:
+            errors = 0
+
+        print(
+            f"{name:<12} {len(samples):>6} {errors:>5} "
+            f"{percentile(samples, 50) * 1000:>8.2f}ms "
+            f"{percentile(samples, 99) * 1000:>8.2f}ms",
+        )
+
+    growth = rss_after - rss_before
+    print()
+    print(
+        f"rss: {rss_before / 1024**2:,.1f}MB -> {rss_after / 1024**2:,.1f}MB "
+        f"({growth / 1024**2:+,.2f}MB, "
+        f"{growth / args.messages * 1000 / 1024:+,.1f}KB per 1k messages)",
+    )
+
+
+# gateway memory usage
+
+
+def guild_data(guild_id: int, channels: int, members: int) -> dict[str, object]:
+    """A GUILD_CREATE payload, roughly as discord sends it."""
+    channel_ids = range(guild_id * 1000, guild_id * 1000 + channels)
+
+    return {
+        "id": guild_id,
+        "name": f"guild {guild_id}",
+        "owner_id": OWNER_ID,
+        "member_count": members,
+        "large": members > 250,
+        "unavailable": False,
+        "roles": [
+            {
+                "id": guild_id * 1000 + 500 + i,
+                "name": f"role {i}",
+                "permissions": "0",
+                "position": i,
+                "color": 0,
+                "hoist": False,
+                "managed": False,
+                "mentionable": False,
+            }
+            for i in range(20)
+        ],
+        "channels": [
+            {
+                "id": channel_id,
+                "type": 0,
+                "name": f"channel-{channel_id}",
+                "position": i,
+                "permission_overwrites": [],
+            }
+            for i, channel_id in enumerate(channel_ids)
+        ],
+        "members": [
+            {
+                "user": user_data(guild_id * 10**6 + i, f"user {i}"),
+                "roles": [],
+                "joined_at": "2021-01-01T00:00:00+00:00",
+                "deaf": False,
+                "mute": False,
+            }
+            for i in range(members)
+        ],
+        "presences": [],
+        "voice_states": [],
+        "emojis": [],
+    }
+
+
+async def measure_memory(args: argparse.Namespace) -> dict[str, float]:
+    config.lean = args.memory_mode == "lean"
+    config.state_path = os.path.join(args.data_dir, "state.pickle")
+
+    bot = sandwich.Sandwich(
+        command_prefix="!",
+        help_command=None,
+        **sandwich.gateway_options(),
+    )
+    bot.process_pool.shutdown()  # not needed
+
+    state = bot._connection
+    state.http = FakeDiscordHTTP()
+    state.user = discord.ClientUser(state=state, data=state.http.bot_user)
+
+    rss_start = rss()
+
+    for guild_id in range(1, args.guilds + 1):
+        state.parse_guild_create(guild_data(guild_id, args.channels, args.members))
+
+    rss_guilds = rss()
+
+    msg_ids = itertools.count(10**16)
+    for i in range(args.messages):
+        guild_id = i % args.guilds + 1
+        author = user_data(guild_id * 10**6 + i % args.members, "user")
+
+        state.parse_message_create(
+            {
+                **message_data(
+                    next(msg_ids),
+                    guild_id * 1000 + i % args.channels,
+                    author,
+                    "just some regular chatter, nothing to see here " * 2,
+                ),
+                "guild_id": guild_id,
+                "member": {"roles": [], "joined_at": "2021-01-01T00:00:00+00:00"},
+            },
+        )
+
+        if i % 100 == 0:
+            await asyncio.sleep(0)  # let the dispatched handlers run
+
+    await asyncio.sleep(0.1)
+    rss_messages = rss()
+
+    return {
+        "per_guild": (rss_guilds - rss_start) / args.guilds,
+        "per_10k_messages": (rss_messages - rss_guilds) / args.messages * 10_000,
+        "total": rss_messages,
+    }
+
+
+def compare_memory(args: argparse.Namespace) -> None:
+    print(
+        f"{args.guilds:,} guilds ({args.channels} channels, {args.members} "
+        f"members each), {args.messages:,} messages",
+    )
+    print()
+    print(f"{'mode':<8} {'per guild':>12} {'per 10k msgs':>14} {'total rss':>11}")
+
+    # each mode in a fresh process, so they can't skew each other
+    for mode in ("default", "lean"):
+        output = subprocess.check_output(
+            [
+                sys.executable,
+                __file__,
+                f"--memory-mode={mode}",
+                f"--guilds={args.guilds}",
+                f"--channels={args.channels}",
+                f"--members={args.members}",
+                f"--messages={args.messages}",
+            ],
+        )
+        result = orjson.loads(output)
+
+        print(
+            f"{mode:<8} {result['per_guild'] / 1024:>10,.1f}KB "
+            f"{result['per_10k_messages'] / 1024**2:>12,.2f}MB "
+            f"{result['total'] / 1024**2:>9,.1f}MB",
+        )
+
+
+# sharded deployment, against a fake gateway
+
+
+def discord_json(data: object) -> web.Response:
+    # NOTE: discord.py only decodes an exact "application/json"
+    return web.Response(
+        body=orjson.dumps(data),
+        headers={"Content-Type": "application/json"},
+    )
+
+
+class FakeGateway:
+    """A local discord (gateway & rest api) for shard processes to connect to."""
+
+    def __init__(self, shard_count: int, guilds_per_shard: int = 2) -> None:
+        self.shard_count = shard_count
+        self.guilds_per_shard = guilds_per_shard
+
+        self.sockets: dict[int, web.WebSocketResponse] = {}  # by shard id
+        self.identifies = 0
+        self.replies = 0
+
+        self.ids = itertools.count(10**17)
+        self.bot_user = user_data(BOT_ID, "sandwich")
+
+    def guild_ids(self, shard_id: int) -> list[int]:
+        # discord picks a guild's shard by (guild_id >> 22) % shard_count
+        return [
+            (i * self.shard_count + shard_id + self.shard_count) << 22
+            for i in range(self.guilds_per_shard)
+        ]
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_get("/api/v7/users/@me", self.get_user)
+        app.router.add_get("/api/v7/gateway", self.get_gateway)
+        app.router.add_post("/api/v7/channels/{channel_id}/messages", self.post_message)
+        app.router.add_route("*", "/api/v7/{tail:.*}", self.no_content)
+        app.router.add_get("/ws", self.websocket)
+        return app
+
+    async def get_user(self, request: web.Request) -> web.Response:
+        return discord_json(self.bot_user)
+
+    async def get_gateway(self, request: web.Request) -> web.Response:
+        return discord_json({"url": f"ws://{request.host}/ws"})
+
+    async def post_message(self, request: web.Request) -> web.Response:
+        payload = await request.json(loads=orjson.loads)
+        self.replies += 1
+
+        channel_id = int(request.match_info["channel_id"])
+        return discord_json(
+            message_data(next(self.ids), channel_id, self.bot_user, payload["content"]),
+        )
+
+    async def no_content(self, request: web.Request) -> web.Response:
+        return web.Response(status=204)
+
+    async def websocket(self, request: web.Request) -> web.WebSocketResponse:
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+
+        seq = itertools.count(1)
+        shard_id: Optional[int] = None
+
+        async def send(payload: dict[str, object]) -> None:
+            await ws.send_str(orjson.dumps(payload).decode())
+
+        await send({"op": 10, "d": {"heartbeat_interval": 41250}})
+
+        async for msg in ws:
+            payload = orjson.loads(msg.data)
+
+            if payload["op"] == 1:  # heartbeat
+                await send({"op": 11})
+            elif payload["op"] == 2:  # identify
+                shard_id, _ = payload["d"]["shard"]
+                guild_ids = self.guild_ids(shard_id)
+
+                await send(
+                    {
+                        "op": 0,
+                        "t": "READY",
+                        "s": next(seq),
+                        "d": {
+                            "v": 6,
+                            "user": self.bot_user,
+                            "guilds": [
+                                {"id": guild_id, "unavailable": True}
+                                for guild_id in guild_ids
+                            ],
+                            "private_channels": [],
+                            "session_id": f"session {shard_id}",
+                            "shard": [shard_id, self.shard_count],
+                        },
+                    },
+                )
+
+                for guild_id in guild_ids:
+                    await send(
+                        {
+                            "op": 0,
+                            "t": "GUILD_CREATE",
+                            "s": next(seq),
+                            "d": guild_data(guild_id, channels=1, members=1),
+                        },
+                    )
+
+                self.sockets[shard_id] = ws
+                self.identifies += 1
+            elif payload["op"] == 6:  # resume; make them identify afresh
+                await send({"op": 9, "d": False})
+
+        if shard_id is not None and self.sockets.get(shard_id) is ws:
+            del self.sockets[shard_id]
+
+        return ws
+
+    async def message(self, shard_id: int, content: str) -> None:
+        """Send a message to (a guild on) one of the shards."""
+        guild_id = random.choice(self.guild_ids(shard_id))
+
+        await self.sockets[shard_id].send_str(
+            orjson.dumps(
+                {
+                    "op": 0,
+                    "t": "MESSAGE_CREATE",
+                    "s": None,
+                    "d": {
+                        **message_data(
+                            next(self.ids),
+                            guild_id * 1000,  # its only channel
+                            user_data(OWNER_ID, "cmyui"),
+                            content,
+                        ),
+                        "guild_id": guild_id,
+                        "member": {
+                            "roles": [],
+                            "joined_at": "2021-01-01T00:00:00+00:00",
+                        },
+                    },
+                },
+            ).decode(),
+        )
+
+
+async def wait_for(condition, timeout: float = 60.0) -> float:
+    """Wait until `condition()` holds, returning how long it took."""
+    start = time.perf_counter()
+
+    while not condition():
+        if time.perf_counter() - start > timeout:
+            raise TimeoutError
+
+        await asyncio.sleep(0.01)
+
+    return time.perf_counter() - start
+
+
+async def run_sharded(args: argparse.Namespace) -> None:
+    gateway = FakeGateway(args.shards)
+
+    runner = web.AppRunner(gateway.app())
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    host, port = runner.addresses[0][:2]
+
+    supervisor = shards.Supervisor(
+        shard_count=args.shards,
+        processes=args.processes,
+        report_interval=0.5,
+        overrides={
+            "discord_token": "fake",
+            "discord_api_url": f"http://{host}:{port}/api/v7",
+            "py_workers": 0,
+            "state_path": os.path.join(args.data_dir, "state.pickle"),
+        },
+    )
+    supervisor_task = asyncio.create_task(asyncio.to_thread(supervisor.run))
+
+    def all_healthy() -> bool:
+        return all(map(supervisor.healthy, supervisor.shards))
+
+    async def load() -> float:
+        """Send our messages across the shards, & wait for every reply."""
+        expected = gateway.replies + args.messages
+
+        start = time.perf_counter()
+        for i in range(args.messages):
+            await gateway.message(i % args.shards, "!how")
+
+        await wait_for(lambda: gateway.replies >= expected)
+        return time.perf_counter() - start
+
+    try:
+        startup = await wait_for(all_healthy)
+        print(
+            f"{args.shards} shards over {len(supervisor.shards)} processes "
+            f"ready in {startup:.2f}s",
+        )
+
+        elapsed = await load()
+        print(
+            f"{args.messages:,} messages in {elapsed:.2f}s "
+            f"({args.messages / elapsed:,.1f} msgs/sec)",
+        )
+
+        # kill a process, & see that it's brought back; after its
+        # latest report, so the totals should account for everything.
+        await asyncio.sleep(1.0)
+        victim = supervisor.shards[0]
+        os.kill(victim.proc.pid, signal.SIGKILL)
+
+        await wait_for(lambda: not supervisor.healthy(victim))
+        recovery = await wait_for(all_healthy)
+        print(f"shards {victim.shard_ids} killed; recovered in {recovery:.2f}s")
+
+        elapsed = await load()
+        print(
+            f"{args.messages:,} messages in {elapsed:.2f}s after recovery "
+            f"({args.messages / elapsed:,.1f} msgs/sec)",
+        )
+
+        await asyncio.sleep(1.0)  # for the latest reports
+        stats = supervisor.stats()
+    finally:
+        supervisor.stop()
+        await supervisor_task
+        await runner.cleanup()
+
+    print()
+    for proc in stats["processes"]:
+        print(
+            f"shards {proc['shard_ids']}: pid {proc['pid']}, "
+            f"{'healthy' if proc['healthy'] else 'unhealthy'}, "
+            f"{proc['guilds']} guilds, {proc['restarts']} restarts",
+        )
+
+    print(f"messages: {stats['messages']}")
+    for name, cmd in stats["commands"].items():
+        print(
+            f"{name}: {cmd['count']:,} calls, {cmd['errors']} errors, "
+            f"p50 {cmd['p50'] * 1000:.1f}ms, p99 {cmd['p99'] * 1000:.1f}ms",
+        )
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--messages", type=int, default=2000)
+    parser.add_argument("--warmup", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument(
+        "--api-latency",
+        type=float,
+        default=0.02,
+        help="seconds the fake openai & github endpoints take to respond",
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--data-dir", default=".data/bench")
+    parser.add_argument("--memory", action="store_true")
+    parser.add_argument("--memory-mode", choices=("default", "lean"))
+    parser.add_argument("--guilds", type=int, default=100)
+    parser.add_argument("--channels", type=int, default=50)
+    parser.add_argument("--members", type=int, default=100)
+    parser.add_argument("--shards", type=int)
+    parser.add_argument("--processes", type=int, default=os.cpu_count() or 1)
+    args = parser.parse_args()
+
+    if args.memory_mode is not None:  # a child of --memory
+        result = asyncio.run(measure_memory(args))
+        sys.stdout.buffer.write(orjson.dumps(result))
+    elif args.memory:
+        compare_memory(args)
+    elif args.shards is not None:
+        asyncio.run(run_sharded(args))
+    else:
+        asyncio.run(run(args))
+
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -7,38 +7,57 @@ repo: https://github.com/cmyui/sandwich
 __author__ = "Joshua Smith (cmyui)"
 __email__ = "cmyuiosu@gmail.com"
 
+import ast
 import asyncio
+import bisect
 import contextlib
+import contextvars
 import datetime
 import dis
+import functools
 import io
+import multiprocessing
 import os
+import pickle
 import platform
-import pprint
 import random
 import shlex
-import subprocess
+import signal
 import sys
+import tempfile
+import time
 import traceback
 import urllib.parse
 import zipfile
-from collections import namedtuple
+from collections import deque
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing.connection import Connection
 from types import FunctionType
+from types import ModuleType
+from typing import AsyncIterator
+from typing import Awaitable
+from typing import Callable
+from typing import Coroutine
+from typing import Iterator
 from typing import Optional
+from typing import TYPE_CHECKING
 
 import aiohttp
 import cpuinfo
 import discord
-import openai
 import index_analysis
 import orjson
 import timeago
 from discord.ext import commands
 
 import config
+import profiler
+import pyworker
+import scanner
 
-
-openai.api_key = os.getenv("OPENAI_API_KEY")
+if TYPE_CHECKING:
+    import numpy as np
 
 SANDWICH_TOPPINGS = [
     "tomatoes",
@@ -84,12 +103,26 @@ def magnitude_fmt(n: float) -> str:
 # finance stuff
 
 
-def sp500_analysis(
+@functools.lru_cache(maxsize=1024)
+def _sp500_real_balance(
     start_date: datetime.date,
     end_date: datetime.date,
     starting_balance: float,
     monthly_contributions: float,
-) -> str:
+) -> float:
+    # prefer the (much faster) scenario engine, if we've its data
+    if (data_path := getattr(config, "sp500_data_path", None)) is not None:
+        # NOTE: imported here, as it brings in numpy; not wanted on
+        # every start (nor in every !py worker, which imports us)
+        import sp500
+
+        return sp500.load(data_path).real_balance(
+            start_date,
+            end_date,
+            starting_balance,
+            monthly_contributions,
+        )
+
     results = index_analysis.analysis.do_analysis(
         start_date=start_date,
         end_date=end_date,
@@ -97,7 +130,21 @@ def sp500_analysis(
         monthly_contributions=monthly_contributions,
     )
 
-    new_balance = results["ending_balance"] / results["ending_inflation"]
+    return results["ending_balance"] / results["ending_inflation"]
+
+
+def sp500_analysis(
+    start_date: datetime.date,
+    end_date: datetime.date,
+    starting_balance: float,
+    monthly_contributions: float,
+) -> str:
+    new_balance = _sp500_real_balance(
+        start_date,
+        end_date,
+        starting_balance,
+        monthly_contributions,
+    )
 
     return (
         f"Estimated value after {timeago.format(end_date, start_date)} "
@@ -106,6 +153,515 @@ def sp500_analysis(
     )
 
 
+def sp500_grid(
+    start_dates: list[datetime.date],
+    end_dates: list[datetime.date],
+    starting_balances: list[float],
+    monthly_contributions: list[float],
+) -> "np.ndarray":
+    """Inflation adjusted balances for every combination of the params.
+
+    Shaped (starts, ends, balances, contributions); needs sp500_data_path.
+    """
+    if (data_path := getattr(config, "sp500_data_path", None)) is None:
+        raise RuntimeError("config.sp500_data_path isn't set.")
+
+    import sp500  # NOTE: see _sp500_real_balance
+
+    return sp500.load(data_path).grid(
+        start_dates,
+        end_dates,
+        starting_balances,
+        monthly_contributions,
+    )
+
+
+# openai stuff
+
+
+class OpenAIError(Exception):
+    pass
+
+
+# what openai charges us, in cents
+DAVINCI_CENTS_PER_TOKEN = (0.02 / 1000) * 100
+IMAGE_CENTS = {"256x256": 1.6, "512x512": 1.8, "1024x1024": 2.0}
+
+
+def openai_cost(endpoint: str, params: dict[str, object], result: object) -> float:
+    """The cost of a request's result, in cents."""
+    if endpoint == "completions":
+        if isinstance(result, list):  # streamed; each event is one token
+            return len(result) * DAVINCI_CENTS_PER_TOKEN
+
+        return result["usage"]["total_tokens"] * DAVINCI_CENTS_PER_TOKEN
+
+    if endpoint == "images/generations":
+        return IMAGE_CENTS.get(params.get("size"), 0.0) * params.get("n", 1)
+
+    return 0.0
+
+
+class SharedStream:
+    """A stream of events read once from upstream, for any number of readers.
+
+    Readers joining late get the events they missed first. If every reader
+    leaves before it's done, upstream is abandoned (unless `keep`, e.g. as
+    it's to be cached); there's no use paying for events nobody reads.
+    """
+
+    def __init__(self, source: AsyncIterator[dict], keep: bool = False) -> None:
+        self.events: list[dict] = []
+        self.done = False
+        self.error: Optional[Exception] = None
+
+        self.keep = keep
+        self.readers = 0
+        self.abandoned = False
+
+        self._changed = asyncio.Event()
+        self.task = asyncio.create_task(self._pump(source))
+
+    def _wake(self) -> None:
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    async def _pump(self, source: AsyncIterator[dict]) -> None:
+        try:
+            async for event in source:
+                self.events.append(event)
+                self._wake()
+        except Exception as exc:
+            self.error = exc
+        finally:
+            self.done = True
+            self._wake()
+
+    async def read(self) -> AsyncIterator[dict]:
+        i = 0
+        self.readers += 1
+
+        try:
+            while True:
+                while i < len(self.events):
+                    yield self.events[i]
+                    i += 1
+
+                if self.done:
+                    if self.error is not None:
+                        raise OpenAIError(*self.error.args)
+                    return
+
+                await self._changed.wait()
+        finally:
+            self.readers -= 1
+
+            # e.g. the last reader's message was edited or deleted
+            if not self.readers and not self.done and not self.keep:
+                self.abandoned = True
+                self.task.cancel()
+
+
+class RequestDedup:
+    """Merges identical openai requests in flight into a single upstream call.
+
+    Results of deterministic requests (i.e. completions at a temperature
+    of 0) may also be kept for a while, in a bounded LRU.
+    """
+
+    def __init__(self, maxsize: int = 0, ttl: float = 60 * 60) -> None:
+        self.maxsize = maxsize
+        self.ttl = ttl
+
+        self._in_flight: dict[str, asyncio.Task] = {}
+        self._streams: dict[str, SharedStream] = {}
+
+        # request in flight -> how many callers are waiting on it
+        self._waiting: dict[asyncio.Task, int] = {}
+
+        # key -> (expires at, result); oldest -> newest use
+        self._cache: OrderedDict[str, tuple[float, object]] = OrderedDict()
+
+        self.upstream = 0
+        self.coalesced = 0
+        self.hits = 0
+        self.cents_saved = 0.0
+
+    @staticmethod
+    def key(endpoint: str, params: dict[str, object], stream: bool = False) -> str:
+        params_json = orjson.dumps(params, option=orjson.OPT_SORT_KEYS).decode()
+        return f"{endpoint}{' (stream)' if stream else ''}:{params_json}"
+
+    def cacheable(self, endpoint: str, params: dict[str, object]) -> bool:
+        return (
+            self.maxsize > 0
+            and endpoint == "completions"
+            and params.get("temperature") == 0
+        )
+
+    def _cached(self, key: str) -> Optional[object]:
+        if (entry := self._cache.get(key)) is None:
+            return None
+
+        expires_at, result = entry
+
+        if time.monotonic() >= expires_at:
+            del self._cache[key]
+            return None
+
+        self._cache.move_to_end(key)
+        return result
+
+    def _store(self, key: str, result: object) -> None:
+        self._cache[key] = (time.monotonic() + self.ttl, result)
+        self._cache.move_to_end(key)
+
+        while len(self._cache) > self.maxsize:
+            self._cache.popitem(last=False)
+
+    def _saved(self, endpoint: str, params: dict[str, object], result: object) -> None:
+        self.cents_saved += openai_cost(endpoint, params, result)
+
+    async def _wait(self, key: str, task: asyncio.Task, keep: bool) -> dict:
+        """Wait on a request in flight; it's cancelled if every caller
+        gives up on it first, unless `keep` (e.g. as it's to be cached)."""
+        self._waiting[task] = self._waiting.get(task, 0) + 1
+
+        try:
+            # NOTE: shielded, so one caller being cancelled
+            # (e.g. by an edit) can't fail the rest.
+            return await asyncio.shield(task)
+        finally:
+            if self._waiting[task] > 1:
+                self._waiting[task] -= 1
+            else:
+                del self._waiting[task]
+
+                if not task.done() and not keep:
+                    task.cancel()
+
+                    # so that anyone asking again gets a fresh request
+                    if self._in_flight.get(key) is task:
+                        del self._in_flight[key]
+
+    async def request(
+        self,
+        endpoint: str,
+        params: dict[str, object],
+        fetch: Callable[[], Awaitable[dict]],
+    ) -> dict:
+        key = self.key(endpoint, params)
+
+        if (result := self._cached(key)) is not None:
+            self.hits += 1
+            self._saved(endpoint, params, result)
+            return result
+
+        cacheable = self.cacheable(endpoint, params)
+
+        if (task := self._in_flight.get(key)) is None:
+            self.upstream += 1
+
+            # NOTE: a task of its own, so it's shared by all its callers
+            task = self._in_flight[key] = asyncio.create_task(fetch())
+
+            def finished(task: asyncio.Task) -> None:
+                if self._in_flight.get(key) is task:
+                    del self._in_flight[key]
+
+                if task.cancelled():
+                    return
+
+                # NOTE: also marks any exception as retrieved
+                if task.exception() is None and cacheable:
+                    self._store(key, task.result())
+
+            task.add_done_callback(finished)
+            return await self._wait(key, task, keep=cacheable)
+
+        self.coalesced += 1
+        result = await self._wait(key, task, keep=cacheable)
+        self._saved(endpoint, params, result)
+        return result
+
+    async def stream(
+        self,
+        endpoint: str,
+        params: dict[str, object],
+        fetch: Callable[[], AsyncIterator[dict]],
+    ) -> AsyncIterator[dict]:
+        key = self.key(endpoint, params, stream=True)
+
+        if (events := self._cached(key)) is not None:
+            self.hits += 1
+            self._saved(endpoint, params, events)
+
+            for event in events:
+                yield event
+            return
+
+        cacheable = self.cacheable(endpoint, params)
+
+        # NOTE: an abandoned stream may not have finished cancelling yet
+        if (stream := self._streams.get(key)) is None or stream.abandoned:
+            self.upstream += 1
+            stream = self._streams[key] = SharedStream(fetch(), keep=cacheable)
+
+            def finished(task: asyncio.Task, stream: SharedStream = stream) -> None:
+                if self._streams.get(key) is stream:
+                    del self._streams[key]
+
+                if not task.cancelled() and stream.error is None and cacheable:
+                    self._store(key, stream.events)
+
+        else:
+            self.coalesced += 1
+
+            def finished(task: asyncio.Task, stream: SharedStream = stream) -> None:
+                # we only know what was saved once it's all arrived
+                if not task.cancelled() and stream.error is None:
+                    self._saved(endpoint, params, stream.events)
+
+        stream.task.add_done_callback(finished)
+
+        async for event in stream.read():
+            yield event
+
+    def stats(self) -> dict[str, object]:
+        requests = self.upstream + self.coalesced + self.hits
+
+        return {
+            "size": len(self._cache),
+            "maxsize": self.maxsize,
+            "upstream": self.upstream,
+            "coalesced": self.coalesced,
+            "hits": self.hits,
+            "hit_rate": round((self.coalesced + self.hits) / (requests or 1), 3),
+            "cents_saved": round(self.cents_saved, 5),
+        }
+
+
+class OpenAIClient:
+    """A small async client for the openai http api.
+
+    At most `max_concurrency` requests are sent upstream at once, and at
+    most `max_queued` more may wait for a slot; anything beyond that is
+    rejected immediately rather than piling up behind a slow api.
+
+    Identical requests are merged (and maybe cached) by `dedup`.
+    """
+
+    def __init__(
+        self,
+        http_sess: aiohttp.ClientSession,
+        api_key: Optional[str],
+        base_url: str = "https://api.openai.com/v1",
+        max_concurrency: int = 4,
+        max_queued: int = 16,
+        timeout: float = 60.0,
+        dedup: Optional[RequestDedup] = None,
+    ) -> None:
+        self.http_sess = http_sess
+        self.api_key = api_key
+        self.base_url = base_url.rstrip("/")
+        self.max_concurrency = max_concurrency
+        self.max_queued = max_queued
+        self.timeout = timeout
+
+        self._sem = asyncio.Semaphore(max_concurrency)
+        self.pending = 0  # in flight + waiting for a slot
+
+        self.dedup = dedup or RequestDedup()
+
+    @contextlib.asynccontextmanager
+    async def _post(
+        self,
+        endpoint: str,
+        payload: dict[str, object],
+        timeout: aiohttp.ClientTimeout,
+    ) -> AsyncIterator[aiohttp.ClientResponse]:
+        if self.pending >= self.max_concurrency + self.max_queued:
+            raise OpenAIError("Too many requests in progress, try again later.")
+
+        self.pending += 1
+        try:
+            async with self._sem:
+                async with self.http_sess.post(
+                    f"{self.base_url}/{endpoint}",
+                    json=payload,
+                    headers={"Authorization": f"Bearer {self.api_key}"},
+                    timeout=timeout,
+                ) as resp:
+                    if resp.status != 200:
+                        try:
+                            data = await resp.json(
+                                loads=orjson.loads, content_type=None
+                            )
+                        except ValueError:  # e.g. an html page from a proxy
+                            raise OpenAIError(f"HTTP {resp.status}: {resp.reason}.")
+
+                        error = (data or {}).get("error") or {}
+                        raise OpenAIError(
+                            error.get("message", f"Request failed ({resp.status})."),
+                        )
+
+                    yield resp
+        except asyncio.TimeoutError:
+            raise OpenAIError(f"Request timed out ({self.timeout:.0f}s).")
+        except aiohttp.ClientError as exc:
+            raise OpenAIError(f"Request failed ({exc.__class__.__name__}).")
+        finally:
+            self.pending -= 1
+
+    async def request(self, endpoint: str, payload: dict[str, object]) -> dict:
+        return await self.dedup.request(
+            endpoint,
+            payload,
+            lambda: self._request(endpoint, payload),
+        )
+
+    async def _request(self, endpoint: str, payload: dict[str, object]) -> dict:
+        timeout = aiohttp.ClientTimeout(total=self.timeout)
+
+        async with self._post(endpoint, payload, timeout) as resp:
+            try:
+                return await resp.json(loads=orjson.loads, content_type=None)
+            except ValueError:
+                raise OpenAIError(f"HTTP {resp.status}: invalid response body.")
+
+    async def stream(
+        self,
+        endpoint: str,
+        payload: dict[str, object],
+    ) -> AsyncIterator[dict]:
+        """Yield each server-sent event of a streamed response as it arrives."""
+        async for event in self.dedup.stream(
+            endpoint,
+            payload,
+            lambda: self._stream(endpoint, payload),
+        ):
+            yield event
+
+    async def _stream(
+        self,
+        endpoint: str,
+        payload: dict[str, object],
+    ) -> AsyncIterator[dict]:
+        # the stream as a whole may take a while; only
+        # time out if the server stops sending for a bit.
+        timeout = aiohttp.ClientTimeout(total=None, sock_read=self.timeout)
+
+        async with self._post(endpoint, {**payload, "stream": True}, timeout) as resp:
+            async for line in resp.content:
+                if not line.startswith(b"data: "):
+                    continue
+
+                data = line.removeprefix(b"data: ").strip()
+                if data == b"[DONE]":
+                    break
+
+                yield orjson.loads(data)
+
+    async def completion(self, **params) -> dict:
+        return await self.request("completions", params)
+
+    async def stream_completion(self, **params) -> AsyncIterator[str]:
+        async for event in self.stream("completions", params):
+            # the api may give up part way through a stream.
+            if "error" in event:
+                raise OpenAIError(event["error"]["message"])
+
+            yield event["choices"][0]["text"]
+
+    async def image(self, **params) -> dict:
+        return await self.request("images/generations", params)
+
+
+class ResponseCache:
+    """A bounded LRU mapping of invoking message ids -> the bot's reply.
+
+    Entries expire `ttl` seconds after they were last written, and the
+    least recently used entry is evicted once `maxsize` is exceeded.
+    """
+
+    def __init__(self, maxsize: int, ttl: float) -> None:
+        self.maxsize = maxsize
+        self.ttl = ttl
+
+        # msg id -> (expires at, bot msg); ordered oldest -> newest use
+        self._entries: OrderedDict[int, tuple[float, discord.Message]] = OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, msg_id: int) -> bool:
+        return self._lookup(msg_id) is not None
+
+    def __setitem__(self, msg_id: int, bot_msg: discord.Message) -> None:
+        self.set(msg_id, bot_msg, self.ttl)
+
+    def set(self, msg_id: int, bot_msg: discord.Message, ttl: float) -> None:
+        self._entries[msg_id] = (time.monotonic() + ttl, bot_msg)
+        self._entries.move_to_end(msg_id)
+
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def __delitem__(self, msg_id: int) -> None:
+        del self._entries[msg_id]
+
+    def _lookup(self, msg_id: int) -> Optional[discord.Message]:
+        if (entry := self._entries.get(msg_id)) is None:
+            return None
+
+        expires_at, bot_msg = entry
+
+        if time.monotonic() >= expires_at:
+            del self._entries[msg_id]
+            self.evictions += 1
+            return None
+
+        self._entries.move_to_end(msg_id)
+        return bot_msg
+
+    def get(self, msg_id: int) -> Optional[discord.Message]:
+        if (bot_msg := self._lookup(msg_id)) is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+
+        return bot_msg
+
+    def pop(self, msg_id: int, default=None) -> Optional[discord.Message]:
+        if (bot_msg := self._lookup(msg_id)) is None:
+            return default
+
+        del self._entries[msg_id]
+        return bot_msg
+
+    def items(self) -> Iterator[tuple[int, float, discord.Message]]:
+        """Yield each live entry's msg id, seconds to live & bot msg."""
+        now = time.monotonic()
+
+        for msg_id, (expires_at, bot_msg) in self._entries.items():
+            if expires_at > now:
+                yield msg_id, expires_at - now, bot_msg
+
+    def stats(self) -> dict[str, int]:
+        return {
+            "size": len(self._entries),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+
 class Context(commands.Context):
     async def send(
         self, content=None, force_new=False, **kwargs
@@ -113,25 +669,29 @@ class Context(commands.Context):
         assert self.message is not None
         assert self.bot is not None
 
-        bot_msg: discord.Message
+        bot_msg: Optional[discord.Message] = None
+
+        if not force_new:
+            bot_msg = self.bot.cache["resp"].get(self.message.id)
 
-        if force_new or self.message.id not in self.bot.cache["resp"]:
+        if bot_msg is None:
             bot_msg = await super().send(content, **kwargs)
 
             if not force_new:  # don't save forced msgs
                 self.bot.cache["resp"][self.message.id] = bot_msg
         else:
-            bot_msg = self.bot.cache["resp"][self.message.id]
             embed = kwargs.get("embed", None)
 
             # if no new content or embed provided, delete
             # the cached bot message from chat & cache.
             if not (embed or content):
                 await bot_msg.delete()
-                del self.bot.cache["resp"][self.message.id]
+                self.bot.cache["resp"].pop(self.message.id)
                 return
 
-            content = content or bot_msg.content
+            # NOTE: replies restored after a restart are partial
+            # messages, which don't know their content.
+            content = content or getattr(bot_msg, "content", None)
             await bot_msg.edit(content=content, embed=embed)
 
         return bot_msg
@@ -175,31 +735,1011 @@ def get_code_from_message_content(
     return cmd_text
 
 
+# the buffer prints from the current task should go to, if any
+_stdout_buffer: contextvars.ContextVar[Optional[io.StringIO]] = contextvars.ContextVar(
+    "stdout_buffer",
+    default=None,
+)
+
+
+class StdoutProxy:
+    """A sys.stdout which sends writes to the current task's capture buffer.
+
+    Tasks which aren't capturing anything write to the real stdout.
+    """
+
+    def __init__(self, stdout) -> None:
+        self.stdout = stdout
+
+    def write(self, s: str) -> int:
+        if (buffer := _stdout_buffer.get()) is not None:
+            return buffer.write(s)
+
+        return self.stdout.write(s)
+
+    def flush(self) -> None:
+        if _stdout_buffer.get() is None:
+            self.stdout.flush()
+
+    def __getattr__(self, name: str):
+        return getattr(self.stdout, name)
+
+
 @contextlib.contextmanager
 def capture_stdout(buffer: io.StringIO):
-    # write to buffer rather than real
-    # stdout while we're in this block
-    real_stdout = sys.stdout
-    sys.stdout = buffer
+    # write to buffer rather than real stdout while
+    # we're in this block; only for the current task.
+    if not isinstance(sys.stdout, StdoutProxy):
+        sys.stdout = StdoutProxy(sys.stdout)
+
+    token = _stdout_buffer.set(buffer)
+
+    try:
+        yield
+    finally:
+        _stdout_buffer.reset(token)
+        buffer.seek(0)
+
+
+# gitlines stuff
+
+
+def chunk_files(
+    files: list[tuple[str, int]],
+    chunk_size: int,
+) -> list[list[str]]:
+    """Group (filename, size) pairs into chunks of about `chunk_size` bytes."""
+    chunks = []
+    chunk: list[str] = []
+    chunk_bytes = 0
+
+    for filename, size in files:
+        chunk.append(filename)
+        chunk_bytes += size
+
+        if chunk_bytes >= chunk_size:
+            chunks.append(chunk)
+            chunk = []
+            chunk_bytes = 0
+
+    if chunk:
+        chunks.append(chunk)
+
+    return chunks
+
+
+def gitlines_count(
+    zip_path: str,
+    filenames: list[str],
+    exts: list[str],
+) -> dict[str, dict[str, int]]:
+    """Count the code & comment lines of some files in a repo archive.
+
+    NOTE: this runs in a worker process.
+    """
+    line_counts = {ext: {"code": 0, "comments": 0} for ext in exts}
+
+    with zipfile.ZipFile(zip_path) as repo_zip:
+        for fname in filenames:
+            ext = next(ext for ext in exts if fname.endswith(f".{ext}"))
+
+            if not (f_content := repo_zip.read(fname)):
+                continue
+
+            counts = scanner.count_lines(f_content, scanner.LANGUAGES_BY_EXT[ext])
+
+            line_counts[ext]["code"] += counts.code
+            line_counts[ext]["comments"] += counts.comments
+
+    return line_counts
+
+
+def format_line_counts(line_counts: dict[str, dict[str, int]]) -> str:
+    return "Total linecounts (inaccurate):\n" + "\n".join(
+        f"{k} | {v}" for k, v in line_counts.items()
+    )
+
+
+class GitlinesCache:
+    """A persistent LRU of !gitlines results.
+
+    Entries are keyed by repo, branch & extensions, and remember the etag
+    (head commit) of the archive they were counted from, so they can be
+    revalidated with a conditional request rather than re-downloaded.
+    """
+
+    def __init__(self, path: str, maxsize: int) -> None:
+        self.path = path
+        self.maxsize = maxsize
+
+        # key -> {"etag": str, "line_counts": dict}; oldest -> newest use
+        self._entries: OrderedDict[str, dict] = OrderedDict()
+
+        if os.path.exists(path):
+            with open(path, "rb") as f:
+                self._entries.update(orjson.loads(f.read()))
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    @staticmethod
+    def key(repo: str, branch: str, exts: list[str]) -> str:
+        return f"{repo}/{branch}:{','.join(sorted(set(exts)))}"
+
+    def get(self, key: str) -> Optional[dict]:
+        if (entry := self._entries.get(key)) is not None:
+            self._entries.move_to_end(key)
+
+        return entry
+
+    def set(
+        self,
+        key: str,
+        etag: str,
+        line_counts: dict[str, dict[str, int]],
+    ) -> None:
+        self._entries[key] = {"etag": etag, "line_counts": line_counts}
+        self._entries.move_to_end(key)
+
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+        self._save()
+
+    def _save(self) -> None:
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+
+        # write to a temp file & swap it in, so a crash
+        # midway through can't leave us with half a cache.
+        with open(f"{self.path}.tmp", "wb") as f:
+            f.write(orjson.dumps(list(self._entries.items())))
+
+        os.replace(f"{self.path}.tmp", self.path)
+
+
+# frequently used modules, for ease of access from !py land
+# TODO: some better way to do this
+PY_NAMESPACE_MODULES = (
+    "aiohttp",
+    "ast",
+    "astpretty",
+    "asyncio",
+    "os",
+    "sys",
+    "struct",
+    "discord",
+    "cmyui",
+    "datetime",
+    "collections",
+    "time",
+    "inspect",
+    "math",
+    "psutil",
+    "re",
+    "pickle",
+    "dill",
+    "signal",
+    "numpy",
+    "socket",
+    "random",
+    "pprint",
+    "pathlib",
+    "hashlib",
+    "platform",
+    "cpuinfo",
+    "bcrypt",
+    "orjson",
+)
+
+
+def uses_names(code_text: str, names: set[str]) -> bool:
+    """Whether !py code uses any of `names` (e.g. `ctx`), which
+    only exist within the bot, and so must run within it."""
+    try:
+        tree = ast.parse(pyworker.wrap_code(code_text))
+    except SyntaxError:
+        return False  # the worker can report it
+
+    return any(
+        isinstance(node, ast.Name) and node.id in names for node in ast.walk(tree)
+    )
+
+
+class PyWorker:
+    def __init__(self, proc: multiprocessing.Process, conn: Connection) -> None:
+        self.proc = proc
+        self.conn = conn
+
+        # names of saved values this worker is yet to receive
+        self.stale: set[str] = set()
+
+
+class PyWorkerPool:
+    """A pool of warm worker processes to run !py snippets in.
+
+    Each worker hosts its own copy of the namespace; values saved in one
+    are pickled & passed on to the others (and to any replacements).
+    """
+
+    def __init__(
+        self,
+        size: int,
+        namespace: dict[str, object],
+        cpu_limit: int = 10,
+        mem_limit: Optional[int] = None,
+        timeout: float = 30.0,
+        max_output: int = 64 * 1024,
+        code_cache_size: int = 256,
+    ) -> None:
+        self.size = size
+        self.namespace = namespace
+        self.cpu_limit = cpu_limit
+        self.mem_limit = mem_limit
+        self.timeout = timeout
+        self.max_output = max_output
+        self.code_cache_size = code_cache_size
+
+        self._mp = multiprocessing.get_context("spawn")
+        self._idle: asyncio.Queue[PyWorker] = asyncio.Queue()
+
+        self.workers: list[PyWorker] = []
+        self.saved: dict[str, bytes] = {}  # name -> pickled value
+        self.restarts = 0
+
+        # module -> the longest it's taken any worker to import
+        self.import_times: dict[str, float] = {}
+
+    def start(self) -> None:
+        for _ in range(self.size):
+            worker = self._spawn()
+            self.workers.append(worker)
+            self._idle.put_nowait(worker)
+
+    def close(self) -> None:
+        for worker in self.workers:
+            worker.proc.kill()
+
+    def _spawn(self) -> PyWorker:
+        conn, child_conn = self._mp.Pipe()
+        proc = self._mp.Process(
+            target=pyworker.run_worker,
+            args=(
+                child_conn,
+                self.namespace,
+                PY_NAMESPACE_MODULES,
+                self.cpu_limit,
+                self.mem_limit,
+                self.max_output,
+                self.code_cache_size,
+            ),
+            daemon=True,
+        )
+        proc.start()
+        child_conn.close()
+
+        worker = PyWorker(proc, conn)
+        worker.stale |= set(self.saved)
+        return worker
+
+    def _restart(self, worker: PyWorker) -> PyWorker:
+        worker.proc.kill()
+        worker.proc.join()
+        worker.conn.close()
+
+        new_worker = self._spawn()
+        self.workers[self.workers.index(worker)] = new_worker
+        self.restarts += 1
+        return new_worker
+
+    def save(self, name: str, value: object) -> bool:
+        """Share a value saved outside of the workers with them."""
+        if (blob := pyworker.dumps(value)) is None:
+            return False
+
+        self._add_saved(name, blob)
+        return True
+
+    def _add_saved(
+        self,
+        name: str,
+        blob: bytes,
+        origin: Optional[PyWorker] = None,
+    ) -> None:
+        self.saved[name] = blob
+
+        for worker in self.workers:
+            if worker is not origin:
+                worker.stale.add(name)
+
+    def _drop_saved(self, name: str) -> None:
+        self.saved.pop(name, None)
+
+        for worker in self.workers:
+            worker.stale.discard(name)
+
+    async def _recv(self, worker: PyWorker) -> tuple:
+        loop = asyncio.get_running_loop()
+        fd = worker.conn.fileno()
+
+        while not worker.conn.poll():
+            readable = loop.create_future()
+            loop.add_reader(fd, lambda: readable.done() or readable.set_result(None))
+            try:
+                await readable
+            finally:
+                loop.remove_reader(fd)
+
+        return worker.conn.recv()
+
+    async def _read_result(self, worker: PyWorker, stdout: io.StringIO) -> tuple:
+        while True:
+            op, *args = await self._recv(worker)
+
+            if op == "stdout":
+                stdout.write(args[0])
+            elif op == "unsaved":  # no use replaying it to the others
+                name, error = args
+                self._drop_saved(name)
+                stdout.write(
+                    f"Dropped saved value {name!r}; can't load it ({error}).\n"
+                )
+            elif op == "imports":
+                for name, seconds in args[0].items():
+                    self.import_times[name] = max(
+                        self.import_times.get(name, 0.0),
+                        seconds,
+                    )
+            else:
+                return (op, *args)
+
+    async def run(self, code_text: str) -> tuple[tuple, str]:
+        """Run some !py code in a worker, returning its result & stdout."""
+        worker = await self._idle.get()
+        stdout = io.StringIO()
+
+        try:
+            # catch the worker up on anything saved elsewhere
+            for name in worker.stale:
+                worker.conn.send(("save", name, self.saved[name]))
+            worker.stale.clear()
+
+            worker.conn.send(("exec", code_text))
+
+            result = await asyncio.wait_for(
+                self._read_result(worker, stdout),
+                self.timeout,
+            )
+        except asyncio.TimeoutError:
+            result = ("error", f"Timed out after {self.timeout:.0f}s.")
+            worker = self._restart(worker)
+        except (EOFError, OSError):
+            worker.proc.join()
+
+            if worker.proc.exitcode == -signal.SIGXCPU:
+                reason = f"cpu time limit of {self.cpu_limit}s exceeded"
+            else:
+                reason = f"exit code {worker.proc.exitcode}"
+
+            result = ("error", f"Worker died ({reason}).")
+            worker = self._restart(worker)
+        except BaseException:  # e.g. cancelled; it may still be running
+            worker = self._restart(worker)
+            raise
+        finally:
+            self._idle.put_nowait(worker)
+
+        if result[0] == "saved":
+            self._add_saved(result[1], result[2], origin=worker)
+
+        return result, stdout.getvalue()
+
+
+class BenchmarkTimeout(Exception):
+    pass
+
+
+class BenchmarkExecutor:
+    """Runs benchmark subprocesses one at a time, off the event loop.
+
+    Jobs are keyed by the id of the invoking message, so they can be
+    cancelled (and their process killed) if that message changes.
+    """
+
+    def __init__(self, cpu: Optional[int] = None, timeout: float = 30.0) -> None:
+        self.cpu = cpu  # core to pin benchmarks to, for more stable numbers
+        self.timeout = timeout
+
+        self._lock = asyncio.Lock()  # waiters are woken in fifo order
+        self.jobs: dict[int, asyncio.Task] = {}
+
+    def _pin_to_cpu(self) -> None:
+        # NOTE: this runs in the child, between fork & exec
+        os.sched_setaffinity(0, {self.cpu})
+
+    async def run(self, job_id: int, args: list[str]) -> tuple[bytes, bytes]:
+        """Queue a command to run, returning its (stdout, stderr)."""
+        self.cancel(job_id)  # superseded by a newer version
+
+        task = asyncio.create_task(self._run(args))
+        self.jobs[job_id] = task
+
+        try:
+            return await task
+        finally:
+            if self.jobs.get(job_id) is task:
+                del self.jobs[job_id]
+
+    def cancel(self, job_id: int) -> bool:
+        if (task := self.jobs.pop(job_id, None)) is None:
+            return False
+
+        task.cancel()
+        return True
+
+    async def _run(self, args: list[str]) -> tuple[bytes, bytes]:
+        async with self._lock:
+            if self.cpu is not None and hasattr(os, "sched_setaffinity"):
+                preexec_fn = self._pin_to_cpu
+            else:
+                preexec_fn = None
+
+            proc = await asyncio.create_subprocess_exec(
+                *args,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE,
+                preexec_fn=preexec_fn,
+            )
+
+            try:
+                return await asyncio.wait_for(proc.communicate(), self.timeout)
+            except asyncio.TimeoutError:
+                raise BenchmarkTimeout(f"Timed out after {self.timeout:.0f}s.")
+            finally:
+                if proc.returncode is None:  # timed out or cancelled
+                    proc.kill()
+                    await proc.wait()
+
+
+class HostInfo:
+    """Details about the host for benchmark headers, collected off the loop.
+
+    Probing the cpu can take a second or so, so it's done once in the
+    background on startup & only redone when explicitly refreshed.
+    """
+
+    def __init__(self) -> None:
+        self.cpu_name: Optional[str] = None
+        self.python_impl = platform.python_implementation()
+        self.python_version: Optional[str] = None
+
+        self._refresh_task: Optional[asyncio.Task] = None
+
+    def refresh(self) -> asyncio.Task:
+        if self._refresh_task is None or self._refresh_task.done():
+            self._refresh_task = asyncio.create_task(self._collect())
+
+        return self._refresh_task
+
+    async def _collect(self) -> None:
+        cpu_info = await asyncio.to_thread(cpuinfo.get_cpu_info)
+
+        cpu_name = cpu_info.get("brand_raw", platform.processor())
+        if not cpu_name.endswith("GHz") and "hz_advertised" in cpu_info:
+            cpu_ghz = cpu_info["hz_advertised"][0] / (1000**3)
+            cpu_name += f" @ {cpu_ghz:.2f} GHz"
+
+        self.cpu_name = cpu_name
+        self.python_version = cpu_info["python_version"]
+
+    async def header(self) -> str:
+        if self.cpu_name is None:  # still collecting
+            await self.refresh()
+
+        return f"{self.cpu_name} | {self.python_impl} v{self.python_version}"
+
+
+class TokenBucket:
+    """Allows `rate` acquisitions every `per` seconds, in bursts of up to `rate`."""
+
+    def __init__(self, rate: int, per: float) -> None:
+        self.rate = rate
+        self.per = per
+
+        self.tokens = float(rate)
+        self.updated = time.monotonic()
+        self._lock = asyncio.Lock()  # waiters are woken in fifo order
+
+    def try_acquire(self) -> float:
+        """Take a token if there is one, else return how long until there is."""
+        now = time.monotonic()
+        self.tokens = min(
+            self.rate,
+            self.tokens + (now - self.updated) * self.rate / self.per,
+        )
+        self.updated = now
+
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+
+        return (1 - self.tokens) * self.per / self.rate
+
+    async def acquire(self) -> None:
+        async with self._lock:
+            while (delay := self.try_acquire()) > 0:
+                await asyncio.sleep(delay)
+
+
+# discord only bulk deletes messages younger than 2 weeks
+# (with a little leeway, in case we're slow getting to them)
+BULK_DELETE_MAX_AGE = datetime.timedelta(days=14) - datetime.timedelta(minutes=5)
+
+# route -> (requests, per seconds), per channel
+BULK_ROUTE_RATES = {
+    "bulk_delete": (1, 1.0),
+    "delete_message": (5, 1.0),
+    "clear_reactions": (4, 1.0),
+}
+
+
+class BulkActions:
+    """Deletes messages & clears reactions en masse, for !ns & !nr.
+
+    Deletes use discord's bulk delete endpoint where the messages are young
+    enough; anything else is sent concurrently, within a budget for each
+    route & channel. Cancelling the calling task stops any further requests.
+    """
+
+    def __init__(
+        self,
+        route_rates: dict[str, tuple[int, float]] = BULK_ROUTE_RATES,
+        progress_interval: float = 2.0,
+    ) -> None:
+        self.route_rates = route_rates
+        self.progress_interval = progress_interval
+
+        self._buckets: dict[tuple[str, int], TokenBucket] = {}
+
+    def _bucket(self, route: str, channel_id: int) -> TokenBucket:
+        if (bucket := self._buckets.get((route, channel_id))) is None:
+            rate, per = self.route_rates[route]
+            bucket = self._buckets[(route, channel_id)] = TokenBucket(rate, per)
+
+        return bucket
+
+    async def _run(
+        self,
+        jobs: list[tuple[str, int, int, Callable[[], Awaitable]]],
+        progress: Optional[Callable[[int, int], Awaitable]],
+    ) -> int:
+        """Run (route, channel id, message count, request) jobs concurrently.
+
+        Returns the number of messages successfully acted upon.
+        """
+        total = sum(count for _, _, count, _ in jobs)
+        done = 0
+
+        async def run_job(route, channel_id, count, request) -> None:
+            nonlocal done
+
+            await self._bucket(route, channel_id).acquire()
+
+            try:
+                await request()
+            except discord.NotFound:
+                pass  # already gone
+            except discord.HTTPException:
+                return
+
+            done += count
+
+        async def report() -> None:
+            while True:
+                await asyncio.sleep(self.progress_interval)
+                await progress(done, total)
+
+        reporter = asyncio.create_task(report()) if progress is not None else None
+
+        try:
+            await asyncio.gather(*[run_job(*job) for job in jobs])
+        finally:
+            if reporter is not None:
+                reporter.cancel()
+
+        return done
+
+    async def delete(
+        self,
+        channel: discord.abc.Messageable,
+        messages: list[discord.Message],
+        progress: Optional[Callable[[int, int], Awaitable]] = None,
+    ) -> int:
+        jobs = []
+
+        if isinstance(channel, discord.TextChannel) and (
+            channel.permissions_for(channel.guild.me).manage_messages
+        ):
+            cutoff = datetime.datetime.utcnow() - BULK_DELETE_MAX_AGE
+            young = [msg for msg in messages if msg.created_at > cutoff]
+            messages = [msg for msg in messages if msg.created_at <= cutoff]
+
+            for i in range(0, len(young), 100):
+                batch = young[i : i + 100]
+
+                if len(batch) == 1:  # bulk delete takes 2-100
+                    messages += batch
+                    continue
+
+                jobs.append(
+                    (
+                        "bulk_delete",
+                        channel.id,
+                        len(batch),
+                        lambda batch=batch: channel.delete_messages(batch),
+                    ),
+                )
+
+        jobs += [("delete_message", msg.channel.id, 1, msg.delete) for msg in messages]
+
+        return await self._run(jobs, progress)
+
+    async def clear_reactions(
+        self,
+        messages: list[discord.Message],
+        progress: Optional[Callable[[int, int], Awaitable]] = None,
+    ) -> int:
+        jobs = [
+            ("clear_reactions", msg.channel.id, 1, msg.clear_reactions)
+            for msg in messages
+            if msg.reactions  # nothing to clear otherwise
+        ]
+
+        return await self._run(jobs, progress)
+
+
+class InvocationScheduler:
+    """Runs the command invocation of each message, one at a time per message.
+
+    Edits are debounced, so a burst of them only runs the latest content,
+    and any invocation still in flight for an older version is cancelled.
+    """
+
+    def __init__(self, debounce: float = 1.0) -> None:
+        self.debounce = debounce
+        self.tasks: dict[int, asyncio.Task] = {}
+
+        self.superseded = 0  # invocations cancelled/skipped for newer content
+
+    def run(self, msg_id: int, coro: Coroutine, delay: float = 0.0) -> asyncio.Task:
+        """Run an invocation for a message, replacing any previous one."""
+        if self.cancel(msg_id):
+            self.superseded += 1
+
+        task = asyncio.create_task(self._run(msg_id, coro, delay))
+        self.tasks[msg_id] = task
+        return task
+
+    def edited(self, msg_id: int, coro: Coroutine) -> asyncio.Task:
+        return self.run(msg_id, coro, delay=self.debounce)
+
+    def cancel(self, msg_id: int) -> bool:
+        if (task := self.tasks.pop(msg_id, None)) is None:
+            return False
+
+        task.cancel()
+        return True
+
+    async def _run(self, msg_id: int, coro: Coroutine, delay: float) -> None:
+        try:
+            if delay:
+                await asyncio.sleep(delay)
+
+            await coro
+        finally:
+            coro.close()  # in case we were cancelled before it started
+
+            if self.tasks.get(msg_id) is asyncio.current_task():
+                del self.tasks[msg_id]
+
+
+# instrumentation stuff
+
+# upper bounds of the latency histogram's buckets, in seconds
+LATENCY_BUCKETS = (
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+    30.0,
+    float("inf"),
+)
+
+
+class LatencyHistogram:
+    def __init__(self, buckets: tuple[float, ...] = LATENCY_BUCKETS) -> None:
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds: float) -> None:
+        self.counts[bisect.bisect_left(self.buckets, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    def percentile(self, p: float) -> float:
+        """Estimate a percentile, as the upper bound of the bucket it's in."""
+        if not self.count:
+            return 0.0
+
+        rank = p / 100 * self.count
+        seen = 0
+
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max)
+
+        return self.max
+
+    def snapshot(self) -> dict[str, object]:
+        return {
+            "count": self.count,
+            "total": self.total,
+            "max": self.max,
+            "p50": self.percentile(50),
+            "p99": self.percentile(99),
+            "buckets": dict(zip(map(str, self.buckets), self.counts)),
+        }
+
+
+class CommandStats:
+    def __init__(self) -> None:
+        self.latency = LatencyHistogram()
+        self.errors = 0
+        self.cancelled = 0  # superseded by an edit, or deleted
+        self.in_flight = 0
+
+
+class Metrics:
+    """Latency, error & in-flight counts per command, and event loop lag.
+
+    Loop lag is sampled by a task which sleeps for `lag_interval` seconds
+    at a time, and measures how much later than that it was woken.
+    """
+
+    def __init__(
+        self,
+        lag_interval: float = 0.5,
+        lag_samples: int = 120,
+        dump_path: Optional[str] = None,
+        dump_interval: float = 60.0,
+    ) -> None:
+        self.lag_interval = lag_interval
+        self.dump_path = dump_path
+        self.dump_interval = dump_interval
+
+        self.commands: dict[str, CommandStats] = {}
+        self.loop_lag: deque[float] = deque(maxlen=lag_samples)
+        self.max_loop_lag = 0.0
+
+        # name -> callable returning the current stats of some cache
+        self.caches: dict[str, Callable[[], dict[str, int]]] = {}
+
+        self._tasks: list[asyncio.Task] = []
+
+    def start(self, snapshot: Callable[[], dict[str, object]]) -> None:
+        self._tasks.append(asyncio.create_task(self._sample_loop_lag()))
+
+        if self.dump_path is not None:
+            self._tasks.append(asyncio.create_task(self._dump(snapshot)))
+
+    def close(self) -> None:
+        for task in self._tasks:
+            task.cancel()
+
+    @contextlib.asynccontextmanager
+    async def track(self, name: str) -> AsyncIterator[CommandStats]:
+        if (stats := self.commands.get(name)) is None:
+            stats = self.commands[name] = CommandStats()
+
+        stats.in_flight += 1
+        start = time.perf_counter()
+
+        try:
+            yield stats
+        except asyncio.CancelledError:
+            stats.cancelled += 1
+            raise
+        except BaseException:
+            stats.errors += 1
+            raise
+        finally:
+            stats.latency.observe(time.perf_counter() - start)
+            stats.in_flight -= 1
+
+    async def _sample_loop_lag(self) -> None:
+        while True:
+            start = time.perf_counter()
+            await asyncio.sleep(self.lag_interval)
+
+            lag = time.perf_counter() - start - self.lag_interval
+            self.loop_lag.append(lag)
+            self.max_loop_lag = max(self.max_loop_lag, lag)
+
+    async def _dump(self, snapshot: Callable[[], dict[str, object]]) -> None:
+        assert self.dump_path is not None
+
+        while True:
+            await asyncio.sleep(self.dump_interval)
+
+            os.makedirs(os.path.dirname(self.dump_path) or ".", exist_ok=True)
+
+            with open(f"{self.dump_path}.tmp", "wb") as f:
+                f.write(orjson.dumps(snapshot(), option=orjson.OPT_INDENT_2))
+
+            os.replace(f"{self.dump_path}.tmp", self.dump_path)
+
+    def snapshot(self) -> dict[str, object]:
+        lag = sorted(self.loop_lag)
+
+        return {
+            "time": time.time(),
+            "commands": {
+                name: {
+                    **stats.latency.snapshot(),
+                    "errors": stats.errors,
+                    "cancelled": stats.cancelled,
+                    "in_flight": stats.in_flight,
+                }
+                for name, stats in self.commands.items()
+            },
+            "loop_lag": {
+                "samples": len(lag),
+                "p50": lag[len(lag) // 2] if lag else 0.0,
+                "last": self.loop_lag[-1] if lag else 0.0,
+                "max": self.max_loop_lag,
+            },
+            "caches": {name: stats() for name, stats in self.caches.items()},
+        }
+
+
+# scheduling stuff
+
+# command -> (concurrency, uses per user, per seconds)
+HEAVY_COMMANDS = {
+    "timeit": (1, 3, 60.0),
+    "profile": (1, 3, 60.0),
+    "gitlines": (2, 5, 60.0),
+    "askai": (4, 5, 60.0),
+    "genimage": (2, 3, 60.0),
+    "py": (4, 20, 60.0),
+}
+
+
+class RateLimited(Exception):
+    pass
+
+
+class FairPool:
+    """Runs at most `concurrency` invocations of a command at once.
+
+    Waiters are queued per user, and served round robin between users,
+    so no one user can starve the others by queueing up lots.
+    """
+
+    def __init__(self, concurrency: int, rate: int, per: float) -> None:
+        self.concurrency = concurrency
+        self.rate = rate
+        self.per = per
+
+        self.running = 0
+        self._queues: OrderedDict[int, deque[asyncio.Future]] = OrderedDict()
+        self._buckets: dict[int, TokenBucket] = {}
+
+        self.waits = LatencyHistogram()
+        self.rate_limited = 0
+
+    def queued(self) -> int:
+        return sum(map(len, self._queues.values()))
+
+    def _position(self, user_id: int, waiter: asyncio.Future) -> int:
+        """How many waiters will be served before this one (round robin)."""
+        users = list(self._queues)
+        mine = users.index(user_id)
+        rounds = self._queues[user_id].index(waiter)
+
+        ahead = rounds
+        for i, other in enumerate(users):
+            if i != mine:
+                # users before us in the rotation get one more turn
+                ahead += min(len(self._queues[other]), rounds + (i < mine))
+
+        return ahead
+
+    def _release(self) -> None:
+        self.running -= 1
+
+        while self._queues and self.running < self.concurrency:
+            user_id, queue = next(iter(self._queues.items()))
+            waiter = queue.popleft()
+
+            if queue:
+                self._queues.move_to_end(user_id)  # their next turn's last
+            else:
+                del self._queues[user_id]
+
+            if not waiter.done():
+                self.running += 1
+                waiter.set_result(None)
+
+    @contextlib.asynccontextmanager
+    async def slot(
+        self,
+        user_id: int,
+        on_queued: Callable[[int], Awaitable],
+    ) -> AsyncIterator[None]:
+        if (bucket := self._buckets.get(user_id)) is None:
+            bucket = self._buckets[user_id] = TokenBucket(self.rate, self.per)
 
-    try:
-        yield
-    finally:
-        # return to real stdout
-        sys.stdout = real_stdout
-        buffer.seek(0)
+        if delay := bucket.try_acquire():
+            self.rate_limited += 1
+            raise RateLimited(delay)
 
+        start = time.perf_counter()
 
-# used for saving values in `Commands().namespace` from !py land
-SavedValue = namedtuple("SavedValue", ["name", "value"])
+        if self.running < self.concurrency and not self._queues:
+            self.running += 1
+        else:
+            waiter = asyncio.get_running_loop().create_future()
+            self._queues.setdefault(user_id, deque()).append(waiter)
 
+            try:
+                await on_queued(self._position(user_id, waiter) + 1)
+                await waiter
+            except BaseException:
+                if not waiter.done() or waiter.cancelled():
+                    # give up our place in the queue
+                    waiter.cancel()
+                    queue = self._queues.get(user_id)
+                    if queue is not None and waiter in queue:
+                        queue.remove(waiter)
+                        if not queue:
+                            del self._queues[user_id]
+                else:  # we were given a slot, but won't use it
+                    self._release()
+                raise
+
+        self.waits.observe(time.perf_counter() - start)
 
-def _save(k: str, v: object) -> SavedValue:
-    return SavedValue(k, v)
+        try:
+            yield
+        finally:
+            self._release()
+
+    def stats(self) -> dict[str, object]:
+        return {
+            "running": self.running,
+            "queued": self.queued(),
+            "concurrency": self.concurrency,
+            "rate_limited": self.rate_limited,
+            "wait": self.waits.snapshot(),
+        }
 
 
-def _saved(g: dict[str, object]) -> dict[str, object]:
-    return {k: g[k] for k in set(g) - {"__builtins__", "__py"}}
+# commands only whitelisted users may use; the ai ones are open to whitelist_ai too
+WHITELISTED_COMMANDS = {"dis", "timeit", "profile", "py"}
+AI_COMMANDS = {"askai", "genimage"}
 
 
 class Commands(commands.Cog):
@@ -230,50 +1770,41 @@ class Commands(commands.Cog):
                 597404438721986560,
                 1011439359083413564,
             }
+
+        # what !addwl & !rmwl changed; kept over restarts, on top of the above
+        self.whitelist_added: set[int] = set()
+        self.whitelist_removed: set[int] = set()
+
         # a dict for our global variables within the !py command.
         # by default, this has functions to save vars, retrieve saved ones,
+        # and also contains frequently used modules for ease of access,
+        # which are only imported once some !py code first uses them.
         self.namespace = {
-            "save": _save,
-            "saved": _saved,
+            "save": pyworker.save,
+            "saved": pyworker.saved,
             "sp500_analysis": sp500_analysis,
+            "sp500_grid": sp500_grid,
         }
-        # and also contains frequently used modules for ease of access.
-        # TODO: some better way to do this
-        for mod_name in (
-            "aiohttp",
-            "ast",
-            "astpretty",
-            "asyncio",
-            "os",
-            "sys",
-            "struct",
-            "discord",
-            "cmyui",
-            "datetime",
-            "collections",
-            "time",
-            "inspect",
-            "math",
-            "psutil",
-            "re",
-            "pickle",
-            "dill",
-            "signal",
-            "numpy",
-            "socket",
-            "random",
-            "pprint",
-            "pathlib",
-            "hashlib",
-            "platform",
-            "cpuinfo",
-            "bcrypt",
-            "orjson",
-        ):
-            try:  # only use ones that're already installed
-                self.namespace[mod_name] = __import__(mod_name)
-            except ModuleNotFoundError:
-                pass
+        pyworker.add_lazy_modules(self.namespace, PY_NAMESPACE_MODULES)
+        self.namespace_builtins = set(self.namespace)
+
+        # saved values which couldn't be pickled for the workers
+        self.unshared: set[str] = set()
+
+        # compiled !py & !dis snippets, so re-runs needn't recompile
+        self.code_cache = pyworker.CodeCache(getattr(config, "code_cache_size", 256))
+
+    def whitelisted(self, ctx: Context) -> bool:
+        """Whether the invoker may use the command (if it's a whitelisted one)."""
+        assert ctx.command is not None
+
+        if (name := ctx.command.qualified_name) in AI_COMMANDS:
+            return ctx.author.id in self.whitelist | self.whitelist_ai
+
+        if name in WHITELISTED_COMMANDS:
+            return ctx.author.id in self.whitelist
+
+        return True
 
     @commands.command(name="g")
     async def google(self, ctx: Context) -> None:
@@ -292,14 +1823,20 @@ class Commands(commands.Cog):
         assert ctx.message is not None
 
         await ctx.message.add_reaction("\N{WHITE HEAVY CHECK MARK}")
-        os.execv(sys.executable, [sys.executable] + sys.argv)
+
+        # carry saved values, whitelists etc. over to the new process
+        self.bot.save_state()
+        self.bot.restart()
 
     @commands.is_owner()
     @commands.command()
     async def addwl(self, ctx: Context) -> None:
         assert ctx.message is not None
 
-        self.whitelist |= set([m.id for m in ctx.message.mentions])
+        user_ids = set([m.id for m in ctx.message.mentions])
+        self.whitelist |= user_ids
+        self.whitelist_added |= user_ids
+        self.whitelist_removed -= user_ids
         await ctx.message.add_reaction("\N{WHITE HEAVY CHECK MARK}")
 
     @commands.is_owner()
@@ -307,14 +1844,15 @@ class Commands(commands.Cog):
     async def rmwl(self, ctx: Context) -> None:
         assert ctx.message is not None
 
-        self.whitelist -= set([m.id for m in ctx.message.mentions])
+        user_ids = set([m.id for m in ctx.message.mentions])
+        self.whitelist -= user_ids
+        self.whitelist_removed |= user_ids
+        self.whitelist_added -= user_ids
         await ctx.message.add_reaction("\N{WHITE HEAVY CHECK MARK}")
 
     @commands.command()
     async def genimage(self, ctx: Context) -> None:
-        whitelist = self.whitelist | self.whitelist_ai
-
-        if ctx.author.id not in whitelist:
+        if not self.whitelisted(ctx):
             await ctx.send(random.choice(NO))
             return
 
@@ -325,18 +1863,23 @@ class Commands(commands.Cog):
             f"{ctx.prefix}{ctx.invoked_with} "
         ).strip()
 
-        openai.api_key = os.getenv("OPENAI_API_KEY")
-        response = openai.Image.create(prompt=prompt, n=1, size="1024x1024")
+        try:
+            response = await self.bot.openai.image(
+                prompt=prompt,
+                n=1,
+                size="1024x1024",
+            )
+        except OpenAIError as exc:
+            await ctx.send(exc.args[0])
+            return
 
         # TODO: price?
 
-        await ctx.send(response.data[0].url)
+        await ctx.send(response["data"][0]["url"])
 
     @commands.command()
     async def askai(self, ctx: Context) -> None:
-        whitelist = self.whitelist | self.whitelist_ai
-
-        if ctx.author.id not in whitelist:
+        if not self.whitelisted(ctx):
             await ctx.send(random.choice(NO))
             return
 
@@ -347,36 +1890,99 @@ class Commands(commands.Cog):
             f"{ctx.prefix}{ctx.invoked_with} "
         ).strip()
 
-        response = openai.Completion.create(
-            model="text-davinci-003",
-            prompt=prompt,
-            temperature=0.9,  # TODO: configurable
-            max_tokens=2048,  # TODO: configurable?
-        )
-        if len(response.choices) != 1:
+        params = {
+            "model": "text-davinci-003",
+            "prompt": prompt,
+            "temperature": getattr(config, "askai_temperature", 0.9),
+            "max_tokens": 2048,  # TODO: configurable?
+        }
+
+        if getattr(config, "askai_stream", True):
+            await self._askai_stream(ctx, params)
+            return
+
+        try:
+            response = await self.bot.openai.completion(**params)
+        except OpenAIError as exc:
+            await ctx.send(exc.args[0])
+            return
+
+        if len(response["choices"]) != 1:
             print("More than 1 choice!")
-            print("\n\n", response.choices, "\n\n")
+            print("\n\n", response["choices"], "\n\n")
 
-        response_text = response.choices[0].text.lstrip("\n")
-        cents_spent = (response.usage.total_tokens * (0.02 / 1000)) * 100
+        response_text = response["choices"][0]["text"].lstrip("\n")
+        total_tokens = response["usage"]["total_tokens"]
+        cents_spent = total_tokens * DAVINCI_CENTS_PER_TOKEN
 
-        if len(response_text) > 2000:
-            with io.StringIO(response_text) as f:
-                response_file = discord.File(f, "response.txt")
-                await ctx.send(
-                    f"Spent {cents_spent:.5f}¢ ({response.usage.total_tokens} tokens) to produce result:", 
-                    file=response_file
-                )
-            
+        await self._send_ai_response(
+            ctx,
+            f"Spent {cents_spent:.5f}¢ ({total_tokens} tokens) to produce result:",
+            response_text,
+        )
+
+    async def _askai_stream(self, ctx: Context, params: dict[str, object]) -> None:
+        """Stream a completion, editing our reply as the text comes in."""
+        edit_interval = getattr(config, "askai_edit_interval", 1.5)
+
+        chunks = []
+        last_edit = time.monotonic()
+
+        try:
+            async for text in self.bot.openai.stream_completion(**params):
+                chunks.append(text)
+
+                # discord only allows a handful of edits every few
+                # seconds, so only show progress every so often.
+                if time.monotonic() - last_edit < edit_interval:
+                    continue
+
+                response_text = "".join(chunks).lstrip("\n")
+
+                if response_text and len(response_text) <= 2000:
+                    await ctx.send(response_text)
+                    last_edit = time.monotonic()
+        except OpenAIError as exc:
+            await ctx.send(exc.args[0])
             return
-        
-        await ctx.send(
-            f"Spent {cents_spent:.5f}¢ ({response.usage.total_tokens} tokens) to produce result:\n\n{response_text}"
+
+        # usage isn't reported for streams; each event is one token.
+        completion_tokens = len(chunks)
+        cents_spent = completion_tokens * DAVINCI_CENTS_PER_TOKEN
+
+        await self._send_ai_response(
+            ctx,
+            f"Spent ~{cents_spent:.5f}¢ (~{completion_tokens} completion tokens) to produce result:",
+            "".join(chunks).lstrip("\n"),
         )
 
+    async def _send_ai_response(
+        self,
+        ctx: Context,
+        header: str,
+        response_text: str,
+    ) -> None:
+        assert ctx.message is not None
+
+        content = f"{header}\n\n{response_text}"
+
+        if len(content) <= 2000:
+            await ctx.send(content)
+            return
+
+        # too long for a message; send it as an attachment.
+        # files can't be added to an edit, so drop any reply
+        # we've already made and send a new one instead.
+        if ctx.message.id in self.bot.cache["resp"]:
+            await ctx.send(None)
+
+        with io.StringIO(response_text) as f:
+            response_file = discord.File(f, "response.txt")
+            await ctx.send(header, file=response_file)
+
     @commands.command()
     async def dis(self, ctx: Context) -> None:
-        if ctx.author.id not in self.whitelist:
+        if not self.whitelisted(ctx):
             await ctx.send(random.choice(NO))
             return
 
@@ -396,7 +2002,7 @@ class Commands(commands.Cog):
         namespace = {}
 
         try:
-            exec(code_text, namespace)
+            exec(self.code_cache.compile(code_text), namespace)
         except:
             await ctx.send(f"```\n{traceback.format_exc()}```")
             await ctx.message.add_reaction("\N{CROSS MARK}")
@@ -432,7 +2038,7 @@ class Commands(commands.Cog):
     @commands.command()
     async def timeit(self, ctx: Context) -> None:
         """Parse & execute python timeit module via bash."""
-        if ctx.author.id not in self.whitelist:
+        if not self.whitelisted(ctx):
             await ctx.send(random.choice(NO))
             return
 
@@ -448,38 +2054,142 @@ class Commands(commands.Cog):
             await ctx.send(f"{exc.args[0]}.")
             return
 
-        # NOTE: to get accurate results here we have to block
-        p = subprocess.Popen(
-            args=bash_args,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-        )
-
-        stdout, stderr = p.communicate()
+        # NOTE: benchmarks run one at a time (optionally pinned
+        # to a core) so they don't skew each other's results.
+        try:
+            stdout, stderr = await self.bot.benchmarks.run(ctx.message.id, bash_args)
+        except BenchmarkTimeout as exc:
+            await ctx.send(exc.args[0])
+            return
 
         if stderr:
             await ctx.send(f"```py\n{stderr.decode()}```")
         elif stdout:
-            cpu_info = cpuinfo.get_cpu_info()
+            host_info = await self.bot.host_info.header()
+            await ctx.send(f"{host_info}\n{stdout.decode()}")
 
-            cpu_name = cpu_info["brand_raw"]
-            if not cpu_name.endswith("GHz"):
-                cpu_ghz = cpu_info["hz_advertised"][0] / (1000**3)
-                cpu_name += f" @ {cpu_ghz:.2f} GHz"
+    @commands.command(aliases=["memprofile"])
+    async def profile(self, ctx: Context) -> None:
+        """Profile code with cProfile (& tracemalloc, as !memprofile)."""
+        if not self.whitelisted(ctx):
+            await ctx.send(random.choice(NO))
+            return
 
-            await ctx.send(
-                "{cpu_name} | {python_impl} v{python_version}\n{output}".format(
-                    **cpu_info,
-                    cpu_name=cpu_name,
-                    output=stdout.decode(),
-                    python_impl=platform.python_implementation(),
-                ),
+        assert ctx.message is not None
+        assert ctx.invoked_with is not None
+
+        try:
+            code_text = get_code_from_message_content(
+                ctx.message.content,
+                ctx.prefix,
+                ctx.invoked_with,
+            )
+        except AssertionError as exc:
+            await ctx.send(exc.args[0])
+            return
+
+        args = [
+            sys.executable,
+            "-m",
+            "profiler",
+            "--top",
+            str(getattr(config, "profile_top", 10)),
+        ]
+        if ctx.invoked_with == "memprofile":
+            args.append("--memory")
+        args += ["--", code_text]
+
+        # NOTE: run like !timeit, in its own process & one at a time.
+        try:
+            stdout, stderr = await self.bot.benchmarks.run(ctx.message.id, args)
+        except BenchmarkTimeout as exc:
+            await ctx.send(exc.args[0])
+            return
+
+        try:
+            result = orjson.loads(stdout.splitlines()[-1])
+        except (IndexError, orjson.JSONDecodeError):
+            # it didn't compile, or the process died
+            if stderr:
+                await ctx.send(f"```py\n{stderr.decode()[-1980:]}```")
+            else:
+                await ctx.send("Profiling failed.")
+            return
+
+        host_info = await self.bot.host_info.header()
+        summary = profiler.summarize(result, limit=2000 - len(host_info) - 1)
+
+        # files can't be added to an edit, so drop
+        # any earlier reply and send a new one instead.
+        if ctx.message.id in self.bot.cache["resp"]:
+            await ctx.send(None)
+
+        with io.StringIO(result["report"]) as f:
+            report_file = discord.File(f, "profile.txt")
+            await ctx.send(f"{host_info}\n{summary}", file=report_file)
+
+    @commands.is_owner()
+    @commands.command()
+    async def hostinfo(self, ctx: Context) -> None:
+        """Re-collect the host details shown in !timeit headers."""
+        await self.bot.host_info.refresh()
+        await ctx.send(await self.bot.host_info.header())
+
+    @commands.is_owner()
+    @commands.command()
+    async def stats(self, ctx: Context) -> None:
+        """Show command latencies, event loop lag, cache stats & import times."""
+        stats = self.bot.stats()
+
+        lines = [
+            f"{'command':<12} {'calls':>6} {'errs':>5} {'busy':>4} "
+            f"{'p50':>8} {'p99':>8} {'max':>8}",
+        ]
+
+        for name, cmd in sorted(stats["commands"].items()):
+            lines.append(
+                f"{name:<12} {cmd['count']:>6} {cmd['errors']:>5} "
+                f"{cmd['in_flight']:>4} {cmd['p50'] * 1000:>6.1f}ms "
+                f"{cmd['p99'] * 1000:>6.1f}ms {cmd['max'] * 1000:>6.1f}ms",
+            )
+
+        lag = stats["loop_lag"]
+        lines += [
+            "",
+            f"loop lag: {lag['last'] * 1000:.1f}ms last, "
+            f"{lag['p50'] * 1000:.1f}ms p50, {lag['max'] * 1000:.1f}ms max "
+            f"({lag['samples']} samples)",
+            "messages: "
+            + ", ".join(f"{k} {v:,}" for k, v in stats["messages"].items()),
+        ]
+
+        for name, cache in stats["caches"].items():
+            lines.append(
+                f"{name} cache: " + ", ".join(f"{k} {v:,}" for k, v in cache.items()),
             )
 
+        for name, queue in stats["queues"].items():
+            lines.append(
+                f"{name} queue: {queue['running']}/{queue['concurrency']} busy, "
+                f"{queue['queued']} queued, {queue['rate_limited']} limited, "
+                f"{queue['wait']['p50'] * 1000:.0f}ms p50 "
+                f"{queue['wait']['p99'] * 1000:.0f}ms p99 wait",
+            )
+
+        for where, times in stats["imports"].items():
+            if times:
+                slowest = sorted(times.items(), key=lambda item: -item[1])
+                lines.append(
+                    f"imports ({where}): "
+                    + ", ".join(f"{k} {v * 1000:.0f}ms" for k, v in slowest),
+                )
+
+        await ctx.send("```\n{}```".format("\n".join(lines)[:1980]))
+
     @commands.command()
     async def py(self, ctx: Context) -> None:
         """Parse & execute message via python interpreter."""
-        if ctx.author.id not in self.whitelist:
+        if not self.whitelisted(ctx):
             await ctx.send(random.choice(NO))
             return
 
@@ -496,14 +2206,23 @@ class Commands(commands.Cog):
             await ctx.send(exc.args[0])
             return
 
-        code_text = f" {code_text}".replace("\n", "\n ")  # indent func code
-        func_def = f"async def __py(ctx):\n{code_text}"
+        if self.bot.py_workers is not None and not uses_names(
+            code_text,
+            {"ctx", *self.unshared},
+        ):
+            await self._py_in_worker(ctx, code_text)
+            return
+
+        func_def = pyworker.wrap_code(code_text)
+        buffer = io.StringIO()
 
         try:
-            exec(func_def, self.namespace)  # compile function
-            ret = await self.namespace["__py"](ctx)  # await it's return
+            with capture_stdout(buffer):
+                # define function & await it's return
+                exec(self.code_cache.compile(func_def), self.namespace)
+                ret = await self.namespace["__py"](ctx)
         except:
-            await ctx.send(f"```{traceback.format_exc()}```")
+            await ctx.send(f"```{buffer.getvalue()}{traceback.format_exc()}```")
             await ctx.message.add_reaction("\N{CROSS MARK}")
             return
         else:
@@ -513,52 +2232,83 @@ class Commands(commands.Cog):
             if "__py" in self.namespace:
                 del self.namespace["__py"]
 
+        stdout = buffer.getvalue()
+
         if ret is None:
-            # clear any previous responses
-            await ctx.send(None)
+            # send anything printed, or clear any previous responses
+            await self._send_py_output(ctx, stdout)
             return
 
         # the return value may be from the !save command.
-        if isinstance(ret, SavedValue):
+        if isinstance(ret, pyworker.SavedValue):
             # NOTE: this will overwrite preexisting vars.
             self.namespace[ret.name] = ret.value
+
+            # if it can't be shared, snippets using it are run here too
+            if self.bot.py_workers is None or self.bot.py_workers.save(
+                ret.name,
+                ret.value,
+            ):
+                self.unshared.discard(ret.name)
+            else:
+                self.unshared.add(ret.name)
+
             await ctx.send(f"Added `{ret.name}` to namespace.")
         else:
-            truncated = False
-
-            if not isinstance(ret, str):
-                # XXX: perhaps i could truncate here as well?
-                # i'll see how it's use goes in practice
-                oversize = sys.getsizeof(ret) - (3 * 1024)  # 3KB
-                if oversize > 0:
-                    await ctx.send(f"Response {oversize}B too large (max 3KB).")
-                    return
+            await self._send_py_output(ctx, stdout + pyworker.format_result(ret))
 
-                ret = pprint.pformat(ret, compact=True)
-            else:
-                if len(ret) > 10000:
-                    await ctx.send("Response way too long.")
-                    return
+    async def _py_in_worker(self, ctx: Context, code_text: str) -> None:
+        assert ctx.message is not None
+
+        (op, *args), stdout = await self.bot.py_workers.run(code_text)
 
-            # discord content len limited to 2k chars.
-            if len(ret) > 2000:
-                ret = ret[:2000]
-                truncated = True
+        if op == "error":
+            await ctx.send(f"```{stdout}{args[0]}```")
+            await ctx.message.add_reaction("\N{CROSS MARK}")
+            return
 
-            await ctx.send(ret)
+        # !py ran successfully.
+        await ctx.message.add_reaction("\N{WHITE HEAVY CHECK MARK}")
 
-            if truncated:
-                await ctx.send(
-                    "(Message truncated to 2k characters)",
-                    force_new=True,
-                    delete_after=3.5,
-                )
+        if op == "saved":
+            name, blob = args
+
+            with contextlib.suppress(Exception):
+                self.namespace[name] = pyworker.loads(blob, self.namespace)
+            self.unshared.discard(name)
+
+            await ctx.send(f"Added `{name}` to namespace.")
+        else:
+            (ret,) = args
+            await self._send_py_output(ctx, stdout + (ret or ""))
+
+    async def _send_py_output(self, ctx: Context, output: str) -> None:
+        if not output:
+            # clear any previous responses
+            await ctx.send(None)
+            return
+
+        truncated = False
+
+        # discord content len limited to 2k chars.
+        if len(output) > 2000:
+            output = output[:2000]
+            truncated = True
+
+        await ctx.send(output)
+
+        if truncated:
+            await ctx.send(
+                "(Message truncated to 2k characters)",
+                force_new=True,
+                delete_after=3.5,
+            )
 
     @commands.command()
     async def gitlines(self, ctx: Context) -> None:
         """Retrieve the linecounts (code, comments) for a given repo & lang."""
-        # NOTE: this is quite inaccurate, as doing this correctly
-        # would basically require parsing the code for each lang lol.
+        # NOTE: this is still a bit inaccurate, as the scanner only knows
+        # about each lang's comments & strings (not e.g. js regex literals).
         # it's just made to get the general idea of the size/ratio.
         assert ctx.message is not None
 
@@ -566,19 +2316,10 @@ class Commands(commands.Cog):
             await ctx.send("Invalid syntax: !gitlines <repo> <file extensions ...>")
             return
 
-        # TODO: better multi-line support
-        lang_comments = {
-            "py": {"single": "#", "multi": ('"""', "'''")},  # wrong but okay for now
-            "pyx": {"single": "#", "multi": ('"""', "'''")},
-            #'go': {'single': '//', 'multi': ()},
-            #'js': {'single': '//', 'multi': ()},
-            #'ts': {'single': '//', 'multi': ()},
-        }
-
         repo, *exts = msg
 
-        if not all([ext in lang_comments for ext in exts]):
-            await ctx.send(f"supported exts: {set(lang_comments)}.")
+        if not all([ext in scanner.LANGUAGES_BY_EXT for ext in exts]):
+            await ctx.send(f"supported exts: {set(scanner.LANGUAGES_BY_EXT)}.")
             return
 
         # repo may contain branch
@@ -587,96 +2328,129 @@ class Commands(commands.Cog):
         else:
             branch = "master"
 
-        repo_url = f"https://github.com/{repo}/archive/{branch}.zip"
-
-        async with self.bot.http_sess.get(repo_url) as resp:
-            if resp.status != 200:
-                await ctx.send(
-                    f'Failed to find repo "{repo}/{branch}" ({resp.status}).',
-                )
-                return
+        github_url = getattr(config, "github_url", "https://github.com")
+        repo_url = f"{github_url}/{repo}/archive/{branch}.zip"
+        max_size = getattr(config, "gitlines_max_size", 64 * 1024**2)
 
-            if resp.content_type != "application/zip":
-                await ctx.send(f"Invalid response (CT: {resp.content_type}).")
-                return
+        # if we've counted this before, ask github whether the archive
+        # (i.e. the branch's head commit) has changed since then.
+        cache_key = GitlinesCache.key(repo, branch, exts)
+        headers = {}
 
-            size_MB = resp.content.total_bytes // (1024**3)
+        if cached := self.bot.gitlines_cache.get(cache_key):
+            headers["If-None-Match"] = cached["etag"]
 
-            if size_MB >= 2:
-                await ctx.send(f"Repo too big ({size_MB:,.2f}MB).")
-                return
+        # spool the archive to disk as it arrives, so we never hold
+        # the whole thing in memory & the worker processes can read it.
+        with tempfile.NamedTemporaryFile(suffix=".zip") as repo_file:
+            async with self.bot.http_sess.get(repo_url, headers=headers) as resp:
+                if resp.status == 304 and cached:
+                    await ctx.send(format_line_counts(cached["line_counts"]))
+                    return
 
-            resp_content = await resp.read()
+                if resp.status != 200:
+                    await ctx.send(
+                        f'Failed to find repo "{repo}/{branch}" ({resp.status}).',
+                    )
+                    return
 
-        with io.BytesIO(resp_content) as data:
-            try:
-                repo_zip = zipfile.ZipFile(data)
-            except Exception as e:
-                print(e)
-                return
+                if resp.content_type != "application/zip":
+                    await ctx.send(f"Invalid response (CT: {resp.content_type}).")
+                    return
 
-            line_counts = {ext: {"code": 0, "comments": 0} for ext in exts}
+                size = 0
 
-            for file in repo_zip.filelist:
-                for ext in exts:
-                    if (fname := file.filename).endswith(ext):
-                        break
-                else:  # not an ext we care abt
-                    continue
+                async for chunk in resp.content.iter_chunked(64 * 1024):
+                    size += len(chunk)
 
-                if ext not in lang_comments:
-                    await ctx.send(f"*.{ext} not yet supported.")
-                    return
+                    if size > max_size:
+                        await ctx.send(
+                            f"Repo too big (over {max_size / 1024**2:,.2f}MB).",
+                        )
+                        return
 
-                if not (f_content := repo_zip.read(file)):
-                    continue
+                    repo_file.write(chunk)
 
-                comments = lang_comments[ext]
-                single_line_comment = comments["single"]
-                multi_line_comment = comments["multi"]
+                # github's archive etag is the commit it was built from
+                etag = resp.headers.get("ETag")
 
-                code_lines = comment_lines = 0
-                in_multi_line_comment = False
+            repo_file.flush()
 
-                lines = f_content.decode().splitlines()
+            try:
+                with zipfile.ZipFile(repo_file.name) as repo_zip:
+                    suffixes = tuple(f".{ext}" for ext in exts)
+                    files = [
+                        (file.filename, file.file_size)
+                        for file in repo_zip.infolist()
+                        if file.filename.endswith(suffixes)
+                    ]
+            except zipfile.BadZipFile as exc:
+                print(exc)
+                return
 
-                # TODO: more languages supported & multi-line comments
-                for line in [l.strip() for l in lines if l]:
-                    if line.startswith(multi_line_comment):
-                        in_multi_line_comment = not in_multi_line_comment
+            # fan the files out to our process pool in chunks
+            # of roughly equal size, and merge the results.
+            loop = asyncio.get_running_loop()
+            results = await asyncio.gather(
+                *[
+                    loop.run_in_executor(
+                        self.bot.process_pool,
+                        gitlines_count,
+                        repo_file.name,
+                        chunk,
+                        exts,
+                    )
+                    for chunk in chunk_files(files, chunk_size=4 * 1024**2)
+                ],
+            )
 
-                    if in_multi_line_comment:
-                        comment_lines += 1
-                        # end of multi line comment
-                        if len(line) != 3 and line.endswith(multi_line_comment):
-                            in_multi_line_comment = False
-                        continue
+        line_counts = {ext: {"code": 0, "comments": 0} for ext in exts}
 
-                    if line.startswith(single_line_comment):
-                        comment_lines += 1
-                    else:
-                        code_lines += 1
+        for result in results:
+            for ext, counts in result.items():
+                line_counts[ext]["code"] += counts["code"]
+                line_counts[ext]["comments"] += counts["comments"]
 
-                line_counts[ext]["code"] += code_lines
-                line_counts[ext]["comments"] += comment_lines
+        if etag is not None:
+            self.bot.gitlines_cache.set(cache_key, etag, line_counts)
 
-        await ctx.send(
-            "Total linecounts (inaccurate):\n"
-            + "\n".join(f"{k} | {v}" for k, v in line_counts.items()),
-        )
+        await ctx.send(format_line_counts(line_counts))
 
     @commands.command()
     async def ns(self, ctx: Context) -> None:  # nuke self's messages
         assert ctx.message is not None
 
-        is_bot = lambda m: m.author == self.bot.user
-        await ctx.channel.purge(check=is_bot, limit=1000)
+        # leave our progress reply alone, if we've one already
+        reply = self.bot.cache["resp"].get(ctx.message.id)
+
+        messages = [
+            msg
+            async for msg in ctx.history(limit=1000)
+            if msg.author == self.bot.user and (reply is None or msg.id != reply.id)
+        ]
+
+        async def progress(done: int, total: int) -> None:
+            await ctx.send(f"Deleted {done:,}/{total:,} messages..")
+
+        await self.bot.bulk_actions.delete(ctx.channel, messages, progress)
+
+        if ctx.message.id in self.bot.cache["resp"]:
+            await ctx.send(None)  # clear the progress
         await ctx.message.add_reaction("\N{WHITE HEAVY CHECK MARK}")
 
     @commands.command()
     async def nr(self, ctx: Context) -> None:  # nuke reactions
-        async for msg in ctx.history():
-            await msg.clear_reactions()
+        assert ctx.message is not None
+
+        messages = [msg async for msg in ctx.history()]
+
+        async def progress(done: int, total: int) -> None:
+            await ctx.send(f"Cleared reactions from {done:,}/{total:,} messages..")
+
+        await self.bot.bulk_actions.clear_reactions(messages, progress)
+
+        if ctx.message.id in self.bot.cache["resp"]:
+            await ctx.send(None)  # clear the progress
 
     @commands.command()
     async def how(self, ctx: Context) -> None:
@@ -688,45 +2462,362 @@ class Sandwich(commands.Bot):
         super().__init__(*args, **kwargs)
 
         self.http_sess: aiohttp.ClientSession
+        self.openai: OpenAIClient
+        self.host_info = HostInfo()
+
+        self.py_workers: Optional[PyWorkerPool] = None
+        if py_workers := getattr(config, "py_workers", 2):
+            self.py_workers = PyWorkerPool(
+                size=py_workers,
+                namespace={"sp500_analysis": sp500_analysis, "sp500_grid": sp500_grid},
+                cpu_limit=getattr(config, "py_cpu_limit", 10),
+                mem_limit=getattr(config, "py_mem_limit", 2 * 1024**3),
+                timeout=getattr(config, "py_timeout", 30.0),
+                code_cache_size=getattr(config, "code_cache_size", 256),
+            )
+
+        self.gitlines_cache = GitlinesCache(
+            path=getattr(config, "gitlines_cache_path", ".data/gitlines.json"),
+            maxsize=getattr(config, "gitlines_cache_size", 256),
+        )
+        self.process_pool = ProcessPoolExecutor(
+            max_workers=getattr(config, "process_pool_workers", None),
+            mp_context=multiprocessing.get_context("spawn"),
+        )
+        self.benchmarks = BenchmarkExecutor(
+            cpu=getattr(config, "timeit_cpu", None),
+            timeout=getattr(config, "timeit_timeout", 30.0),
+        )
+        self.bulk_actions = BulkActions(
+            progress_interval=getattr(config, "bulk_progress_interval", 2.0),
+        )
+        self.invocations = InvocationScheduler(
+            debounce=getattr(config, "edit_debounce", 1.0),
+        )
 
-        self.cache = {"resp": {}}  # many kinds
+        self.cache = {  # many kinds
+            "resp": ResponseCache(
+                maxsize=getattr(config, "resp_cache_size", 1024),
+                ttl=getattr(config, "resp_cache_ttl", 60 * 60),
+            ),
+        }
+
+        # fair queues for the expensive commands
+        self.heavy_pools = {
+            name: FairPool(concurrency, rate, per)
+            for name, (concurrency, rate, per) in getattr(
+                config,
+                "heavy_commands",
+                HEAVY_COMMANDS,
+            ).items()
+        }
 
-        self.add_cog(Commands(self))
+        # messages seen by process_commands, & what came of them
+        self.msg_counts = {"filtered": 0, "dispatched": 0}
 
-    async def run(self, token: str, *args, **kwargs) -> None:
+        self.metrics = Metrics(
+            lag_interval=getattr(config, "loop_lag_interval", 0.5),
+            dump_path=getattr(config, "stats_dump_path", None),
+            dump_interval=getattr(config, "stats_dump_interval", 60.0),
+        )
+
+        cog = Commands(self)
+        self.add_cog(cog)
+
+        # replies to restore once we can see their channels
+        self._restored_resp: list[tuple[int, float, int, int]] = []
+
+        self.state_path = getattr(config, "state_path", ".data/state.pickle")
+        if os.path.exists(self.state_path):
+            self.load_state()
+
+        # outlives the openai client (& its session), as the metrics see it
+        self.openai_dedup = RequestDedup(
+            maxsize=getattr(config, "openai_cache_size", 256),
+            ttl=getattr(config, "openai_cache_ttl", 60 * 60),
+        )
+
+        self.metrics.caches |= {
+            "resp": self.cache["resp"].stats,
+            "openai": self.openai_dedup.stats,
+            "code": cog.code_cache.stats,
+            "gitlines": lambda: {
+                "size": len(self.gitlines_cache),
+                "maxsize": self.gitlines_cache.maxsize,
+            },
+        }
+
+    def stats(self) -> dict[str, object]:
+        """A snapshot of the bot's metrics, for !stats & the periodic dump."""
+        return {
+            **self.metrics.snapshot(),
+            "messages": {
+                **self.msg_counts,
+                "superseded": self.invocations.superseded,
+            },
+            "queues": {name: pool.stats() for name, pool in self.heavy_pools.items()},
+            "py_worker_restarts": (
+                self.py_workers.restarts if self.py_workers is not None else 0
+            ),
+            # how long the !py namespace's modules took to import
+            "imports": {
+                "bot": pyworker.import_times,
+                "py workers": (
+                    self.py_workers.import_times if self.py_workers is not None else {}
+                ),
+            },
+        }
+
+    def restart(self) -> None:
+        os.execv(sys.executable, [sys.executable] + sys.argv)
+
+    def save_state(self) -> None:
+        """Snapshot the state we'd otherwise lose over a restart."""
+        cog: Commands = self.get_cog("Commands")
+
+        # values saved from !py; those saved within the workers
+        # are already pickled, and take precedence.
+        saved = {}
+
+        for name, value in cog.namespace.items():
+            if (
+                name in cog.namespace_builtins
+                or name.startswith("__")
+                or isinstance(value, ModuleType)
+            ):
+                continue
+
+            if (blob := pyworker.dumps(value)) is not None:
+                saved[name] = blob
+
+        if self.py_workers is not None:
+            saved |= self.py_workers.saved
+
+        state = {
+            "saved": saved,
+            # NOTE: only the changes; the defaults may have been edited since
+            "whitelist_changes": (cog.whitelist_added, cog.whitelist_removed),
+            "resp": [
+                (msg_id, ttl, bot_msg.channel.id, bot_msg.id)
+                for msg_id, ttl, bot_msg in self.cache["resp"].items()
+            ],
+        }
+
+        os.makedirs(os.path.dirname(self.state_path) or ".", exist_ok=True)
+
+        with open(f"{self.state_path}.tmp", "wb") as f:
+            pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+        os.replace(f"{self.state_path}.tmp", self.state_path)
+
+    def load_state(self) -> None:
+        """Restore a snapshot from `save_state`; it's only used once."""
+        cog: Commands = self.get_cog("Commands")
+
+        try:
+            with open(self.state_path, "rb") as f:
+                state = pickle.load(f)
+        except Exception:
+            traceback.print_exc()
+            return
+        finally:
+            os.remove(self.state_path)
+
+        for name, blob in state["saved"].items():
+            try:
+                cog.namespace[name] = pyworker.loads(blob, cog.namespace)
+            except Exception:
+                continue  # e.g. its class no longer exists
+
+            # NOTE: the workers haven't started yet; they'll
+            # be sent these along with their first snippet.
+            if self.py_workers is not None:
+                self.py_workers.saved[name] = blob
+
+        added, removed = state.get("whitelist_changes", (set(), set()))
+        cog.whitelist_added |= added
+        cog.whitelist_removed |= removed
+        cog.whitelist = (cog.whitelist | added) - removed
+
+        self._restored_resp = state["resp"]
+
+    async def setup(self) -> None:
+        """Create the bot's sessions & start its background workers."""
         self.http_sess = aiohttp.ClientSession(
             json_serialize=lambda x: orjson.dumps(x).decode(),
         )
+        self.openai = OpenAIClient(
+            self.http_sess,
+            api_key=os.getenv("OPENAI_API_KEY"),
+            base_url=getattr(config, "openai_base_url", "https://api.openai.com/v1"),
+            max_concurrency=getattr(config, "openai_max_concurrency", 4),
+            max_queued=getattr(config, "openai_max_queued", 16),
+            timeout=getattr(config, "openai_timeout", 60.0),
+            dedup=self.openai_dedup,
+        )
+
+        # collect host details in the background, for !timeit
+        self.host_info.refresh()
+
+        if self.py_workers is not None:
+            self.py_workers.start()
+
+        self.metrics.start(self.stats)
+
+    async def teardown(self) -> None:
+        self.metrics.close()
+
+        await self.http_sess.close()
+        self.process_pool.shutdown(wait=False, cancel_futures=True)
+
+        if self.py_workers is not None:
+            self.py_workers.close()
+
+    async def run(self, token: str, *args, **kwargs) -> None:
+        await self.setup()
 
         try:
             await self.start(token, *args, **kwargs)
         except:
-            await self.http_sess.close()
+            await self.teardown()
             await self.close()
 
-    async def process_commands(self, msg: discord.Message) -> None:
+    def _may_be_command(self, content: str) -> bool:
+        """Cheaply check whether a message could invoke a command."""
+        prefixes = self.command_prefix
+        if isinstance(prefixes, str):
+            prefixes = (prefixes,)
+        elif not isinstance(prefixes, (tuple, list)):
+            return True  # dynamic prefix; leave it to get_context
+
+        for prefix in prefixes:
+            if content.startswith(prefix):
+                name, *_ = content[len(prefix) :].split(maxsplit=1) or ("",)
+                return name in self.all_commands
+
+        return False
+
+    def _schedule(self, msg: discord.Message, edited: bool = False) -> None:
+        """Schedule the command invocation of a (new or edited) message."""
         if msg.author.bot:
             # don't process messages for bots
             return
 
+        # most messages aren't commands; skip those before going to
+        # the trouble of scheduling them, or building a context.
+        if not self._may_be_command(msg.content):
+            self.msg_counts["filtered"] += 1
+
+            # it may have been edited from a command; stop that
+            if edited and self.invocations.cancel(msg.id):
+                self.invocations.superseded += 1
+            return
+
+        self.msg_counts["dispatched"] += 1
+
+        if edited:
+            # wait for the edits to settle, then run only the latest content;
+            # anything still running for the old content is cancelled.
+            self.invocations.edited(msg.id, self.process_commands(msg))
+        else:
+            # tracked, so that an edit can cancel it
+            self.invocations.run(msg.id, self.process_commands(msg))
+
+    async def process_commands(self, msg: discord.Message) -> None:
+        # NOTE: messages are filtered before they're scheduled; see _schedule
         ctx = await self.get_context(msg, cls=Context)
         await self.invoke(ctx)
 
+    async def invoke(self, ctx: Context) -> None:
+        if ctx.command is None:
+            return await super().invoke(ctx)
+
+        name = ctx.command.qualified_name
+
+        async with self.metrics.track(name) as stats:
+            if (pool := self.heavy_pools.get(name)) is None:
+                await super().invoke(ctx)
+            else:
+                await self._invoke_heavy(ctx, pool)
+
+            # errors are handled (& swallowed) within invoke
+            if ctx.command_failed:
+                stats.errors += 1
+
+    async def _invoke_heavy(self, ctx: Context, pool: FairPool) -> None:
+        # turn away those who may not use it up front, rather than have
+        # them queue (& use up their rate limit) only to be told so
+        if isinstance(ctx.cog, Commands) and not ctx.cog.whitelisted(ctx):
+            await ctx.send(random.choice(NO))
+            return
+
+        async def on_queued(position: int) -> None:
+            await ctx.send(f"Queued (position {position}); hang tight..")
+
+        try:
+            async with pool.slot(ctx.author.id, on_queued):
+                await super().invoke(ctx)
+        except RateLimited as exc:
+            await ctx.send(f"Slow down! Try again in {exc.args[0]:.0f}s.")
+
     async def on_ready(self):
+        # our replies from before a restart may be edited again,
+        # though we only know them by id (& channel) now.
+        for msg_id, ttl, channel_id, bot_msg_id in self._restored_resp:
+            if (channel := self.get_channel(channel_id)) is not None:
+                self.cache["resp"].set(
+                    msg_id,
+                    channel.get_partial_message(bot_msg_id),
+                    ttl,
+                )
+
+        self._restored_resp.clear()
+
         print(f"\x1b[0;92m{self.user} up\x1b[0m")
 
     async def on_message(self, msg: discord.Message) -> None:
-        await self.process_commands(msg)
+        self._schedule(msg)
 
     async def on_message_edit(
         self,
         before: discord.Message,
         after: discord.Message,
     ) -> None:
-        await self.process_commands(after)
+        # e.g. discord unfurling a link into an embed; nothing to re-run
+        if before.content == after.content:
+            return
+
+        self._schedule(after, edited=True)
+
+    async def on_raw_message_edit(self, payload: discord.RawMessageUpdateEvent) -> None:
+        if payload.cached_message is not None:
+            return  # on_message_edit has it
+
+        # in lean mode, (almost) nothing's in discord.py's message cache;
+        # build the message from the event, if it's a full one.
+        if "content" not in payload.data or "author" not in payload.data:
+            return
+
+        if (channel := self.get_channel(payload.channel_id)) is None:
+            return
+
+        msg = discord.Message(
+            state=self._connection,
+            channel=channel,
+            data=payload.data,
+        )
+        self._schedule(msg, edited=True)
+
+    async def on_raw_message_delete(
+        self,
+        payload: discord.RawMessageDeleteEvent,
+    ) -> None:
+        # NOTE: raw, as the message may not be in discord.py's cache
+
+        # stop anything still running for it
+        self.invocations.cancel(payload.message_id)
 
-    async def on_message_delete(self, msg: discord.Message) -> None:
-        if previous_resp := self.cache["resp"].pop(msg.id, None):
+        if previous_resp := self.cache["resp"].pop(payload.message_id, None):
             await previous_resp.delete()
 
     async def on_command_error(
@@ -741,11 +2832,33 @@ class Sandwich(commands.Bot):
             return await super().on_command_error(ctx, error)
 
 
+def gateway_options() -> dict[str, object]:
+    """discord.py client options, per the configured mode.
+
+    Commands only need the invoking message & our own replies (which are in
+    cache["resp"]), so lean mode leaves out intents, discord.py's message
+    cache & member chunking which would only cost memory.
+    """
+    if not getattr(config, "lean", False):
+        return {}
+
+    return {
+        "intents": discord.Intents(
+            guilds=True,  # for the channel cache
+            guild_messages=True,
+            dm_messages=True,
+        ),
+        "max_messages": getattr(config, "lean_max_messages", None),
+        "member_cache_flags": discord.MemberCacheFlags.none(),
+        "chunk_guilds_at_startup": False,
+    }
+
+
 async def main() -> int:
     # set cwd to main directory
     os.chdir(os.path.dirname(os.path.realpath(__file__)))
 
-    bot = Sandwich(command_prefix="!", help_command=None)
+    bot = Sandwich(command_prefix="!", help_command=None, **gateway_options())
     await bot.run(config.discord_token)
 
     return 0
@@ -0,0 +1,272 @@
+"""profiler - profile a snippet with cprofile (& tracemalloc), for !profile.
+
+run as `python -m profiler [--top N] [--memory] CODE`; the snippet is run
+once under cprofile, then (with --memory) again under tracemalloc, so its
+timings don't include tracemalloc's overhead. anything it prints is kept
+for the report, and the results are written out as a single line of json:
+
+    {
+        "calls": ..., "time": ...,  # totals, from cprofile
+        "functions": [...],  # the top N, by cumulative time
+        "allocations": [...] or null,  # the top N sites, by size
+        "peak": ... or null,  # peak traced memory, in bytes
+        "error": ... or null,  # the traceback, if the snippet raised
+        "report": ...,  # the full text report
+    }
+
+`summarize` formats those results into a discord sized message.
+"""
+import argparse
+import contextlib
+import cProfile
+import io
+import json
+import os
+import pstats
+import sys
+import traceback
+import tracemalloc
+from typing import Optional
+
+# how much of the snippet's output to keep for the report
+MAX_OUTPUT = 64 * 1024
+
+# how many allocation sites to list in the full report
+REPORT_ALLOCATIONS = 100
+
+
+def _short_path(path: str) -> str:
+    head, tail = os.path.split(path)
+
+    if tail == "__init__.py":  # the package's name is more useful
+        return f"{os.path.basename(head)}/{tail}"
+
+    return tail
+
+
+def _func_name(key: tuple[str, int, str]) -> str:
+    filename, lineno, name = key
+
+    if filename == "~":  # a builtin, e.g. <built-in method builtins.len>
+        return name
+
+    return f"{_short_path(filename)}:{lineno}({name})"
+
+
+# the profiler's own entry, from turning it off
+_DISABLE_KEY = ("~", 0, "<method 'disable' of '_lsprof.Profiler' objects>")
+
+
+def _run(
+    code: object,
+    namespace: dict[str, object],
+    stdout: io.StringIO,
+    profiler: Optional[cProfile.Profile] = None,
+) -> Optional[str]:
+    """Run the snippet, returning its traceback if it fails."""
+    try:
+        with contextlib.redirect_stdout(stdout):
+            if profiler is not None:
+                profiler.enable()
+
+            try:
+                exec(code, namespace)
+            finally:
+                if profiler is not None:
+                    profiler.disable()
+    except BaseException:
+        return traceback.format_exc()
+
+    return None
+
+
+def profile(code_text: str, top: int, memory: bool) -> dict[str, object]:
+    code = compile(code_text, "<string>", "exec")
+    stdout = io.StringIO()
+
+    profiler = cProfile.Profile()
+    error = _run(code, {"__name__": "__main__"}, stdout, profiler)
+
+    stats = pstats.Stats(profiler)
+    if (entry := stats.stats.pop(_DISABLE_KEY, None)) is not None:
+        stats.prim_calls -= entry[0]
+        stats.total_calls -= entry[1]
+    rows = sorted(stats.stats.items(), key=lambda item: item[1][3], reverse=True)
+
+    functions = [
+        {
+            "name": _func_name(key),
+            "calls": calls,
+            "primitive_calls": primitive_calls,
+            "tottime": tottime,
+            "cumtime": cumtime,
+        }
+        for key, (primitive_calls, calls, tottime, cumtime, _) in rows[:top]
+    ]
+
+    report = io.StringIO()
+    stats.stream = report
+    stats.sort_stats("cumulative").print_stats()
+
+    allocations = peak = None
+
+    if memory:
+        # NOTE: the namespace is kept until the snapshot's taken,
+        # so what the snippet leaves in its globals is counted.
+        namespace = {"__name__": "__main__"}
+
+        tracemalloc.start()
+        _run(code, namespace, io.StringIO())
+        snapshot = tracemalloc.take_snapshot()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        del namespace
+
+        snapshot = snapshot.filter_traces(
+            (
+                tracemalloc.Filter(False, tracemalloc.__file__),
+                tracemalloc.Filter(False, __file__),
+            ),
+        )
+        sites = snapshot.statistics("lineno")
+
+        allocations = [
+            {
+                "site": "{}:{}".format(
+                    _short_path(stat.traceback[0].filename),
+                    stat.traceback[0].lineno,
+                ),
+                "size": stat.size,
+                "count": stat.count,
+            }
+            for stat in sites[:top]
+        ]
+
+        report.write(
+            f"\ntracemalloc: {peak:,} bytes peak, "
+            f"{sum(stat.size for stat in sites):,} bytes still allocated in "
+            f"{len(sites):,} sites (top {REPORT_ALLOCATIONS}, by size):\n\n",
+        )
+        for stat in sites[:REPORT_ALLOCATIONS]:
+            report.write(f"{stat}\n")
+
+    if output := stdout.getvalue():
+        report.write(f"\nstdout:\n{output[:MAX_OUTPUT]}")
+
+    if error is not None:
+        report.write(f"\n{error}")
+
+    return {
+        "calls": stats.total_calls,
+        "time": stats.total_tt,
+        "functions": functions,
+        "allocations": allocations,
+        "peak": peak,
+        "error": error,
+        "report": report.getvalue(),
+    }
+
+
+# formatting
+
+
+def _size(n: float) -> str:
+    for unit in ("B", "KiB", "MiB"):
+        if abs(n) < 1024:
+            return f"{n:.0f}{unit}" if unit == "B" else f"{n:.1f}{unit}"
+        n /= 1024
+
+    return f"{n:.1f}GiB"
+
+
+def _render(
+    result: dict,
+    functions: list[dict],
+    allocations: Optional[list[dict]],
+    width: int,
+) -> str:
+    lines = [
+        f"{result['calls']:,} function calls in {result['time']:.4f}s; "
+        f"top {len(functions)} by cumulative time:",
+        "```",
+        f"{'ncalls':>9} {'tottime':>8} {'cumtime':>8}  function",
+    ]
+
+    for func in functions:
+        if func["calls"] == func["primitive_calls"]:
+            calls = str(func["calls"])
+        else:  # recursive; like pstats, show total/primitive
+            calls = f"{func['calls']}/{func['primitive_calls']}"
+
+        name = func["name"]
+        if len(name) > width:
+            name = f"..{name[-(width - 2):]}"
+
+        lines.append(
+            f"{calls:>9} {func['tottime']:>8.4f} {func['cumtime']:>8.4f}  {name}",
+        )
+
+    lines.append("```")
+
+    if allocations is not None:
+        lines += [
+            f"{_size(result['peak'])} peak traced memory; "
+            f"top {len(allocations)} allocation sites:",
+            "```",
+            f"{'size':>9} {'count':>7}  site",
+        ]
+        lines += [
+            f"{_size(alloc['size']):>9} {alloc['count']:>7,}  {alloc['site'][-width:]}"
+            for alloc in allocations
+        ]
+        lines.append("```")
+
+    if result["error"] is not None:
+        # just the exception itself; the traceback's in the report
+        lines.append(f"Raised `{result['error'].rstrip().splitlines()[-1]}`.")
+
+    return "\n".join(lines)
+
+
+def summarize(result: dict, limit: int = 2000, width: int = 60) -> str:
+    """Format the top functions & allocation sites into `limit` chars.
+
+    Rows are dropped from the bottom of the longer table until it fits.
+    """
+    functions = list(result["functions"])
+    allocations = result["allocations"]
+    if allocations is not None:
+        allocations = list(allocations)
+
+    while len(text := _render(result, functions, allocations, width)) > limit:
+        if allocations and len(allocations) >= len(functions):
+            allocations.pop()
+        elif functions:
+            functions.pop()
+        else:
+            return text[:limit]
+
+    return text
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("code")
+    parser.add_argument("--top", type=int, default=10)
+    parser.add_argument("--memory", action="store_true")
+    args = parser.parse_args()
+
+    try:
+        result = profile(args.code, args.top, args.memory)
+    except SyntaxError:
+        print(traceback.format_exc(limit=0), file=sys.stderr)
+        return 1
+
+    # NOTE: on a line of its own, in case the snippet
+    # wrote to the real stdout (e.g. through os.write).
+    sys.stdout.write(f"\n{json.dumps(result)}\n")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,479 @@
+"""pyworker - out-of-process execution for sandwich's !py command.
+
+each worker is a long-lived process hosting its own copy of the !py
+namespace. it receives code over a pipe, runs it under cpu & memory
+limits, and sends back anything printed followed by the (formatted)
+return value. if a snippet takes the worker down, only it is lost.
+"""
+import asyncio
+import contextlib
+import importlib.util
+import io
+import math
+import pickle
+import pprint
+import resource
+import time
+import traceback
+import types
+from collections import Counter
+from collections import defaultdict
+from collections import deque
+from collections import namedtuple
+from collections import OrderedDict
+from multiprocessing.connection import Connection
+from types import CodeType
+from typing import Iterable
+from typing import Iterator
+from typing import Optional
+
+# used for saving values in the !py namespace from !py land
+SavedValue = namedtuple("SavedValue", ["name", "value"])
+
+
+def save(k: str, v: object) -> SavedValue:
+    return SavedValue(k, v)
+
+
+def saved(g: dict[str, object]) -> dict[str, object]:
+    return {
+        k: g[k]
+        for k in set(g) - {"__builtins__", "__py"}
+        if not isinstance(g[k], LazyModule)  # not yet used
+    }
+
+
+def dumps(value: object) -> Optional[bytes]:
+    """Pickle a saved value, so it can be passed between processes.
+
+    functions & classes defined in !py can't be pickled by reference, so
+    dill (if installed) is used to pickle those by value. returns None if
+    the value can't be pickled at all.
+    """
+    try:
+        return pickle.dumps(value)
+    except Exception:
+        pass
+
+    try:
+        import dill
+    except ImportError:
+        return None
+
+    try:
+        # NOTE: recurse, so only the globals they use are pickled along
+        return dill.dumps(value, recurse=True)
+    except Exception:
+        return None
+
+
+def _with_globals(func: types.FunctionType, namespace: dict) -> types.FunctionType:
+    rebound = types.FunctionType(
+        func.__code__,
+        namespace,
+        func.__name__,
+        func.__defaults__,
+        func.__closure__,
+    )
+    rebound.__kwdefaults__ = func.__kwdefaults__
+    rebound.__qualname__ = func.__qualname__
+    rebound.__annotations__ = func.__annotations__
+    rebound.__dict__.update(func.__dict__)
+    return rebound
+
+
+def loads(blob: bytes, namespace: dict[str, object]) -> object:
+    """Unpickle a value from `dumps` into a !py namespace.
+
+    functions pickled by value come back with a copy of the globals they
+    used, so they're rebound to the namespace; that way they see its (lazy)
+    modules & later saves, as they did where they were defined.
+    """
+    value = pickle.loads(blob)
+
+    # NOTE: those defined in !py have no __module__, as the namespace has no
+    # __name__; library functions (pickled by reference) are left alone.
+    if isinstance(value, types.FunctionType) and value.__module__ is None:
+        return _with_globals(value, namespace)
+
+    if isinstance(value, type):
+        for name, attr in list(vars(value).items()):
+            if isinstance(attr, types.FunctionType) and attr.__module__ is None:
+                setattr(value, name, _with_globals(attr, namespace))
+
+    return value
+
+
+# module -> how long it took to import, for those imported by a LazyModule
+import_times: dict[str, float] = {}
+
+
+class LazyModule(types.ModuleType):
+    """A stand-in for a !py namespace module, which imports it on first use.
+
+    Once imported, the real module takes its place in the namespace, so
+    only the first attribute lookup goes through here; the namespace itself
+    stays an exact dict, keeping !py's global lookups on the fast path.
+    """
+
+    def __init__(self, name: str, namespace: Optional[dict] = None) -> None:
+        super().__init__(name)
+        self.__namespace = namespace
+        self.__module: Optional[types.ModuleType] = None
+
+    def __getattr__(self, attr: str) -> object:
+        if self.__module is None:
+            name = self.__name__
+
+            start = time.perf_counter()
+            self.__module = importlib.import_module(name)
+            import_times.setdefault(name, time.perf_counter() - start)
+
+            if self.__namespace is not None and self.__namespace.get(name) is self:
+                self.__namespace[name] = self.__module
+
+        return getattr(self.__module, attr)
+
+    def __reduce__(self):
+        # e.g. in the globals of a saved function; no need to import it here
+        return (LazyModule, (self.__name__,))
+
+
+def add_lazy_modules(namespace: dict[str, object], modules: Iterable[str]) -> None:
+    """Add a LazyModule to the namespace for each of the modules installed."""
+    for name in modules:
+        if importlib.util.find_spec(name) is not None:
+            namespace[name] = LazyModule(name, namespace)
+
+
+class CodeCache:
+    """A bounded LRU of compiled code objects, keyed by their source.
+
+    Snippets are often re-run as-is (e.g. when their message is edited),
+    so this saves parsing & compiling them again each time.
+    """
+
+    def __init__(self, maxsize: int = 256) -> None:
+        self.maxsize = maxsize
+        self._code: OrderedDict[str, CodeType] = OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        return len(self._code)
+
+    def compile(self, source: str) -> CodeType:
+        if (code := self._code.get(source)) is not None:
+            self._code.move_to_end(source)
+            self.hits += 1
+            return code
+
+        self.misses += 1
+
+        # NOTE: same filename as exec() uses for strings
+        code = compile(source, "<string>", "exec")
+
+        self._code[source] = code
+        if len(self._code) > self.maxsize:
+            self._code.popitem(last=False)
+
+        return code
+
+    def stats(self) -> dict[str, int]:
+        return {
+            "size": len(self._code),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+
+def wrap_code(code_text: str) -> str:
+    """Wrap !py code into an async function, so it may use await & return."""
+    code_text = f" {code_text}".replace("\n", "\n ")  # indent func code
+    return f"async def __py(ctx):\n{code_text}"
+
+
+_BRACKETS = {
+    list: ("[", "]"),
+    tuple: ("(", ")"),
+    set: ("{", "}"),
+    frozenset: ("{", "}"),
+    dict: ("{", "}"),
+    deque: ("[", "]"),
+}
+
+# the reprs of containers we know how to reproduce; others (e.g. namedtuples)
+# have their own, which could show anything
+_CONTAINER_REPRS = {cls.__repr__ for cls in _BRACKETS} | {
+    OrderedDict.__repr__,
+    Counter.__repr__,
+    defaultdict.__repr__,
+}
+
+# ints bigger than this aren't converted to decimal; that's quadratic
+_MAX_INT_BITS = 4096
+
+
+def _brackets(obj: object) -> tuple[str, str]:
+    """What goes around a container's items, e.g. OrderedDict({ & })."""
+    base = next(base for base in _BRACKETS if isinstance(obj, base))
+    open_, close = _BRACKETS[base]
+
+    if type(obj) in (list, tuple, set, dict):
+        return open_, close
+
+    # NOTE: subclasses are named, as are the likes of frozenset
+    name = type(obj).__name__
+
+    if isinstance(obj, defaultdict):
+        return f"{name}({obj.default_factory!r}, {open_}", f"{close})"
+
+    if isinstance(obj, deque) and obj.maxlen is not None:
+        return f"{name}({open_}", f"{close}, maxlen={obj.maxlen})"
+
+    return f"{name}({open_}", f"{close})"
+
+
+def _leaf_repr(obj: object) -> str:
+    try:
+        return repr(obj)
+    except Exception:  # as reprlib does
+        return f"<{type(obj).__name__} instance at {id(obj):#x}>"
+
+
+def _iter_repr(obj: object, limit: int, frames: list, path: set[int]) -> Iterator[str]:
+    """Yield the repr of `obj` piece by piece, as it's walked.
+
+    `frames` tracks how far through each open container we are, & any
+    leaves (e.g. long strings) which were cut short, so the caller can
+    tell how much went unshown.
+
+    NOTE: a Counter's items are shown as they're stored, rather than
+    most common first; sorting them would mean going through them all.
+    """
+    if type(obj).__repr__ in _CONTAINER_REPRS and obj:
+        open_, close = _brackets(obj)
+
+        if id(obj) in path:  # recursive
+            yield f"{open_}...{close}"
+            return
+
+        frame = ["items", len(obj), 0]
+        frames.append(frame)
+        path.add(id(obj))
+
+        yield open_
+
+        is_dict = isinstance(obj, dict)
+
+        for i, item in enumerate(obj.items() if is_dict else obj):
+            if i:
+                yield ", "
+
+            if is_dict:
+                yield from _iter_repr(item[0], limit, frames, path)
+                yield ": "
+                yield from _iter_repr(item[1], limit, frames, path)
+            else:
+                yield from _iter_repr(item, limit, frames, path)
+
+            frame[2] = i + 1
+
+        if isinstance(obj, tuple) and len(obj) == 1:
+            yield ","
+
+        path.discard(id(obj))
+        # NOTE: not pop(); the frame of a long string (or such) within it
+        # is left above it. (& an open frame never equals a finished one)
+        frames.remove(frame)
+
+        yield close
+    elif isinstance(obj, (str, bytes)) and len(obj) > limit:
+        frames.append(["characters", len(obj), limit])
+        yield repr(obj[:limit])
+    elif isinstance(obj, int) and (bits := obj.bit_length()) > _MAX_INT_BITS:
+        frames.append(["digits", int(bits * math.log10(2)) + 1, 0])
+        yield f"<{type(obj).__name__} of {bits:,} bits>"
+    elif len(text := _leaf_repr(obj)) > limit:
+        # e.g. some custom repr; it's already been built, but needn't be kept
+        frames.append(["characters", len(text), limit])
+        yield text[:limit]
+    else:
+        yield text
+
+
+def render(obj: object, limit: int) -> tuple[str, Optional[str]]:
+    """Render `obj` as repr() would, stopping after about `limit` chars.
+
+    Returns the text along with a description of what was left out, if
+    anything was; the work done is proportional to the text produced.
+    """
+    frames: list = []
+    pieces = []
+    size = 0
+
+    for piece in _iter_repr(obj, limit, frames, set()):
+        pieces.append(piece)
+
+        if (size := size + len(piece)) >= limit:
+            break
+
+    text = "".join(pieces)
+
+    if not frames:  # nothing left open or cut short; but it may run over
+        if size <= limit:
+            return text, None
+
+        return text[:limit], f"{size - limit:,} more characters"
+
+    # describe what's left of the outermost container (or cut leaf)
+    kind, total, shown = frames[0]
+
+    if shown == total:
+        return text, None
+
+    if kind == "characters":
+        elided = f"{total - shown:,} more characters"
+    elif kind == "digits":
+        elided = f"about {total:,} digits"
+    else:
+        elided = f"{total - shown:,} of {total:,} items not fully shown"
+
+    return text[:limit], elided
+
+
+# room to leave for saying what didn't fit
+_ELIDED_NOTE_SIZE = 64
+
+
+def format_result(ret: object, limit: int = 2000) -> str:
+    """Format a !py return value into (at most `limit` chars of) text."""
+    if isinstance(ret, str):
+        if len(ret) <= limit:
+            return ret
+
+        text = ret[: limit - _ELIDED_NOTE_SIZE]
+        return f"{text}\n... ({len(ret) - len(text):,} more characters)"
+
+    text, elided = render(ret, limit - _ELIDED_NOTE_SIZE)
+
+    if elided is None:
+        # it's small; pretty print it as usual
+        try:
+            return pprint.pformat(ret, compact=True)
+        except Exception:  # e.g. a repr which raises
+            return text
+
+    return f"{text}\n... ({elided})"
+
+
+class _PipeWriter(io.TextIOBase):
+    """A stdout which sends what's written back to the bot as it happens."""
+
+    def __init__(self, conn: Connection, max_output: int) -> None:
+        self.conn = conn
+        self.remaining = max_output
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, s: str) -> int:
+        if s and self.remaining > 0:
+            self.conn.send(("stdout", s[: self.remaining]))
+            self.remaining -= len(s)
+
+        return len(s)
+
+
+def _limit_cpu_time(seconds: int) -> None:
+    # RLIMIT_CPU counts the process' total cpu time, so
+    # push the limit to `seconds` past what's used so far.
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    used = int(usage.ru_utime + usage.ru_stime)
+
+    _, hard = resource.getrlimit(resource.RLIMIT_CPU)
+    resource.setrlimit(resource.RLIMIT_CPU, (used + seconds, hard))
+
+
+def _run_code(
+    namespace: dict[str, object],
+    loop: asyncio.AbstractEventLoop,
+    code_cache: CodeCache,
+    code_text: str,
+) -> tuple:
+    try:
+        exec(code_cache.compile(wrap_code(code_text)), namespace)  # define function
+        ret = loop.run_until_complete(namespace["__py"](None))  # await it's return
+    except:
+        return ("error", traceback.format_exc())
+    finally:
+        namespace.pop("__py", None)
+
+    if ret is None:
+        return ("return", None)
+
+    # the return value may be from the !save command.
+    if isinstance(ret, SavedValue):
+        # it's no use kept in this worker alone; snippets run in any of them
+        if (blob := dumps(ret.value)) is None:
+            return ("error", f"Can't save {ret.name!r}; it can't be pickled.")
+
+        # NOTE: this will overwrite preexisting vars.
+        namespace[ret.name] = ret.value
+
+        return ("saved", ret.name, blob)
+
+    return ("return", format_result(ret))
+
+
+def run_worker(
+    conn: Connection,
+    namespace: dict[str, object],
+    module_names: tuple[str, ...],
+    cpu_limit: int,
+    mem_limit: Optional[int],
+    max_output: int,
+    code_cache_size: int,
+) -> None:
+    """The entrypoint of a worker process."""
+    if mem_limit is not None:
+        resource.setrlimit(resource.RLIMIT_AS, (mem_limit, mem_limit))
+
+    namespace |= {"save": save, "saved": saved}
+    add_lazy_modules(namespace, module_names)
+
+    code_cache = CodeCache(code_cache_size)
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+
+    while True:
+        try:
+            op, *args = conn.recv()
+        except EOFError:  # the bot's gone
+            return
+
+        if op == "save":  # a value saved elsewhere
+            name, blob = args
+
+            # it may depend on state only the worker it came from has
+            try:
+                namespace[name] = loads(blob, namespace)
+            except Exception as exc:
+                conn.send(("unsaved", name, f"{exc.__class__.__name__}: {exc}"))
+        elif op == "exec":
+            (code_text,) = args
+
+            _limit_cpu_time(cpu_limit)
+            imported = len(import_times)
+
+            with contextlib.redirect_stdout(_PipeWriter(conn, max_output)):
+                result = _run_code(namespace, loop, code_cache, code_text)
+
+            # report any imports it took, for the bot's stats
+            if len(import_times) != imported:
+                conn.send(("imports", import_times))
+
+            conn.send(result)
@@ -0,0 +1,524 @@
+"""scanner - a fast(ish) code/comment line counter for a handful of languages.
+
+each language is described by a table of its comment & string syntax, from
+which a few regexes are built. blank lines & those starting with a comment
+are counted for the whole file at once (a few passes of c over its bytes,
+never splitting it into lines); then only block comments & strings spanning
+lines are stepped through, to correct those counts, each found with
+bytes.find rather than a regex.
+
+NOTE: this is still a few passes rather than one, & ~5-15% slower on the
+stdlib than the naive loop over stripped lines it replaced (which got strings
+with a # in them, code after a block comment, etc. wrong); the accuracy is
+what the remaining difference buys.
+
+run this file directly for a throughput benchmark.
+"""
+
+import re
+import sys
+import time
+from collections import namedtuple
+from typing import Optional
+
+Language = namedtuple(
+    "Language",
+    [
+        "name",
+        "line_comments",  # tuple of tokens, e.g. (b"//",)
+        "block_comments",  # tuple of (start, end) tokens
+        "nested_blocks",  # whether block comments nest (rust)
+        "strings",  # tuple of (start, end, multi_line, escapes)
+        "docstrings",  # whether a string starting a line is a comment (python)
+        "atoms",  # regexes always matched whole as code, e.g. char literals
+    ],
+)
+
+LineCounts = namedtuple("LineCounts", ["code", "comments", "blank"])
+
+PYTHON = Language(
+    name="python",
+    line_comments=(b"#",),
+    block_comments=(),
+    nested_blocks=False,
+    strings=(
+        (b'"""', b'"""', True, True),
+        (b"'''", b"'''", True, True),
+        (b'"', b'"', False, True),
+        (b"'", b"'", False, True),
+    ),
+    docstrings=True,
+    atoms=(),
+)
+
+C_FAMILY = Language(
+    name="c-family",
+    line_comments=(b"//",),
+    block_comments=((b"/*", b"*/"),),
+    nested_blocks=False,
+    strings=(
+        (b'"', b'"', False, True),
+        (b"'", b"'", False, True),
+    ),
+    docstrings=False,
+    atoms=(),
+)
+
+GO = Language(
+    name="go",
+    line_comments=(b"//",),
+    block_comments=((b"/*", b"*/"),),
+    nested_blocks=False,
+    strings=(
+        (b"`", b"`", True, False),  # raw string
+        (b'"', b'"', False, True),
+        (b"'", b"'", False, True),
+    ),
+    docstrings=False,
+    atoms=(),
+)
+
+JAVASCRIPT = Language(
+    name="javascript",
+    line_comments=(b"//",),
+    block_comments=((b"/*", b"*/"),),
+    nested_blocks=False,
+    strings=(
+        (b"`", b"`", True, True),  # template literal
+        (b'"', b'"', False, True),
+        (b"'", b"'", False, True),
+    ),
+    docstrings=False,
+    atoms=(),
+)
+
+RUST = Language(
+    name="rust",
+    line_comments=(b"//",),
+    block_comments=((b"/*", b"*/"),),
+    nested_blocks=True,
+    strings=((b'"', b'"', True, True),),
+    docstrings=False,
+    # a lone ' is a lifetime, so only whole char literals are strings
+    atoms=(rb"'(?:\\.|[^\\'\n])'",),
+)
+
+LANGUAGES_BY_EXT = {
+    "py": PYTHON,
+    "pyi": PYTHON,
+    "pyx": PYTHON,
+    "c": C_FAMILY,
+    "h": C_FAMILY,
+    "cc": C_FAMILY,
+    "cpp": C_FAMILY,
+    "cxx": C_FAMILY,
+    "hpp": C_FAMILY,
+    "cs": C_FAMILY,
+    "java": C_FAMILY,
+    "go": GO,
+    "js": JAVASCRIPT,
+    "jsx": JAVASCRIPT,
+    "mjs": JAVASCRIPT,
+    "cjs": JAVASCRIPT,
+    "ts": JAVASCRIPT,
+    "tsx": JAVASCRIPT,
+    "rs": RUST,
+}
+
+
+# whitespace, other than newlines
+_SPACES = b" \t\r\f\v"
+
+
+# a newline directly after another, once a line's spaces are taken out
+_EMPTY_LINE = re.compile(rb"\n(?=\n)")
+
+
+def _line_totals(data: bytes, comment_starts: tuple[bytes, ...]) -> tuple[int, ...]:
+    """Count the lines which aren't blank, those which are, & those after the
+    first which start with a line comment; `comment_starts` are the comment
+    tokens after a newline.
+
+    NOTE: this is a few passes of c, without splitting the data into lines;
+    only the blank lines are stepped through (by the regex engine).
+    """
+    data = data.translate(None, _SPACES)
+    comments = sum(map(data.count, comment_starts))
+
+    blank = len(_EMPTY_LINE.findall(data)) + data.startswith(b"\n")
+    lines = data.count(b"\n") + (data[-1:] not in (b"", b"\n")) - blank
+
+    return lines, blank, comments
+
+
+def _string_body(end: bytes, multi_line: bool, escapes: bool) -> bytes:
+    """Build a regex for the body of a string, up to (not including) its end."""
+    first = re.escape(end[:1])
+    stops = first + (rb"\\" if escapes else b"") + (b"" if multi_line else b"\n")
+
+    # i.e. [^"\\]*(?:\\.[^"\\]*)*
+    others = []
+    if escapes:
+        others.append(rb"\\.")
+    if len(end) > 1:  # only part of the end, e.g. " or "" before """
+        others.append(rb"%s(?!%s)" % (first, re.escape(end[1:])))
+
+    body = rb"[^%s]*" % stops
+    if others:
+        body += rb"(?:(?:%s)[^%s]*)*" % (b"|".join(others), stops)
+
+    return body
+
+
+class _Patterns:
+    """The compiled regexes of a language, & what to do with each token.
+
+    only block comments & strings which may span lines need tracking from
+    one line to the next; their start tokens are the "spans". everything
+    else (line comments, other strings & atoms) only affects its own line.
+    """
+
+    def __init__(self, lang: Language) -> None:
+        # start token -> (kind, ...)
+        self.spans: dict[bytes, tuple] = {}
+
+        for start, end in lang.block_comments:
+            if lang.nested_blocks:
+                seek = re.compile(b"|".join(map(re.escape, (start, end))))
+            else:
+                seek = None
+            self.spans[start] = ("block", end, seek)
+
+        for start, end, multi_line, escapes in lang.strings:
+            if multi_line:
+                rest = _string_body(end, multi_line, escapes)
+                self.spans[start] = (
+                    "string",
+                    end,
+                    re.compile(rb"%s(?:%s)?" % (rest, re.escape(end)), re.DOTALL),
+                    # a string on a line of its own is a docstring
+                    lang.docstrings,
+                )
+
+        self.line_comments = lang.line_comments
+
+        self.comment_starts = tuple(b"\n" + token for token in lang.line_comments)
+
+        # NOTE: all of a language's line comments start the same way
+        self.comment_first = lang.line_comments[0][:1]
+        line_comment = b"|".join(map(re.escape, lang.line_comments))
+        self.comment_lines = re.compile(rb"\n[%s]*(?:%s)" % (_SPACES, line_comment))
+
+        # a line's code (including strings & atoms), up to any comment or span
+        tokens = [
+            *lang.line_comments,
+            *(start for start, _ in lang.block_comments),
+            *(start for start, *_ in lang.strings),
+        ]
+        not_span = rb"(?!%s)" % b"|".join(map(re.escape, self.spans))
+
+        alternatives = [
+            rb"%s%s%s%s" % (not_span, re.escape(start), _string_body(*rest), end)
+            for start, end, *rest in (
+                (start, re.escape(end), end, multi_line, escapes)
+                for start, end, multi_line, escapes in lang.strings
+                if not multi_line
+            )
+        ]
+        alternatives += lang.atoms
+        alternatives.append(rb"\\.")
+
+        specials = {b"\n", b"\\"} | {t[:1] for t in tokens}
+        specials |= {atom[:1] for atom in lang.atoms}  # must start with a literal
+
+        for byte in sorted(specials - {b"\n", b"\\"}):
+            if byte in tokens:
+                continue
+
+            # e.g. a / which isn't a comment; or a ' which isn't a char literal
+            rests = [re.escape(t[1:]) for t in tokens if t[:1] == byte]
+            if rests:
+                alternatives.append(rb"%s(?!%s)" % (re.escape(byte), b"|".join(rests)))
+            else:
+                alternatives.append(re.escape(byte))
+
+        others = b"".join(re.escape(c) for c in specials)
+        self.code = re.compile(
+            rb"(?:[^%s]+|%s)*" % (others, b"|".join(alternatives)),
+        )
+
+
+_patterns: dict[Language, _Patterns] = {}
+
+
+def count_lines(data: bytes, lang: Language) -> LineCounts:
+    """Count the code, comment & blank lines of a file's contents.
+
+    blank lines, & lines which are just a line comment, are counted up front;
+    every other line is code, unless it's inside (or made up of) block comments
+    & docstrings. so only those, & strings which may span lines, are stepped
+    through one by one.
+
+    NOTE: a single-line string continued onto the next line with a
+    backslash is taken to end with its line; in practice they're rare.
+    """
+    if (patterns := _patterns.get(lang)) is None:
+        patterns = _patterns[lang] = _Patterns(lang)
+
+    size = len(data)
+    find = data.find
+    rfind = data.rfind
+
+    spans = patterns.spans
+    line_comments = patterns.line_comments
+    comment_first = patterns.comment_first
+
+    # NOTE: those lines starting with a comment which turn out to
+    # be within a span are taken back off as the spans are found.
+    lines, blank, comments = _line_totals(data, patterns.comment_starts)
+
+    # where the last span ended, & what's on its line so far
+    last_end = 0
+    line_has_code = line_has_comment = False
+
+    # the next occurrence of each span's start token
+    next_at = dict.fromkeys(spans, -1)
+    search_from = 0
+
+    while True:
+        pos = size
+        for start, at in next_at.items():
+            if at < search_from:
+                at = find(start, search_from)
+                next_at[start] = at = size if at == -1 else at
+
+            if at < pos:
+                pos, token = at, start
+
+        if pos == size:
+            break
+
+        # make sure it's not within a string or comment
+        scan_start = rfind(b"\n", last_end, pos) + 1 or last_end
+        prefix = data[scan_start:pos].strip()
+
+        if prefix:  # NOTE: usually there's none, e.g. for a docstring
+            code_end = patterns.code.match(data, scan_start).end()
+
+            if code_end != pos:
+                if code_end > pos:  # within a string (or e.g. a char literal)
+                    search_from = code_end
+                else:  # within a line comment (or a broken string)
+                    search_from = find(b"\n", pos) % (size + 1)
+                continue
+
+        if scan_start == last_end:  # still on the same line
+            if prefix:
+                line_has_code = True
+        else:
+            # that line's done, as are those in between (without spans)
+            nl = find(b"\n", last_end)
+            rest = data[last_end:nl].strip()
+
+            if rest.startswith(line_comments):
+                line_has_comment = True
+            elif rest:
+                line_has_code = True
+
+            if line_has_comment and not line_has_code:
+                comments += 1
+
+            line_has_code = bool(prefix)
+            line_has_comment = False
+
+        span = spans[token]
+        pos_end = pos + len(token)
+
+        if span[0] == "string":
+            _, end_token, body, docstring = span
+            is_comment = docstring and not line_has_code
+
+            # without a backslash, it simply ends at the first end token
+            end = find(end_token, pos_end)
+            if end == -1 or find(b"\\", pos_end, end) != -1:
+                end = body.match(data, pos_end).end()
+            else:
+                end += len(end_token)
+        else:
+            _, end_token, seek = span
+            is_comment = True
+
+            if seek is None:
+                end = find(end_token, pos_end)
+                end = size if end == -1 else end + len(end_token)
+            else:  # nested block comments
+                depth = 1
+                end = pos_end
+
+                while depth and (m := seek.search(data, end)) is not None:
+                    end = m.end()
+                    depth += 1 if m.group() != end_token else -1
+
+                if depth:
+                    end = size
+
+        if (nl := find(b"\n", pos, end)) == -1:  # all on the one line
+            if is_comment:
+                line_has_comment = True
+            else:
+                line_has_code = True
+        else:
+            line_start = rfind(b"\n", nl, end) + 1
+
+            # the lines after the first aren't what they seemed
+            if find(comment_first, nl, end) != -1:
+                comments -= len(patterns.comment_lines.findall(data, nl, end))
+
+            if is_comment:
+                if not line_has_code:  # the first line
+                    comments += 1
+
+                # the lines in between are comments, unless they're blank
+                between = data[nl + 1 : line_start].translate(None, _SPACES)
+                comments += between.count(b"\n") - between.startswith(b"\n")
+                comments -= len(_EMPTY_LINE.findall(between))
+
+            # NOTE: an unterminated span may end just after a newline
+            line_has_code = not is_comment and line_start != end
+            line_has_comment = is_comment and line_start != end
+
+        last_end = search_from = end
+
+    # the rest of the last span's line
+    nl = find(b"\n", last_end) % (size + 1)
+    rest = data[last_end:nl].strip()
+
+    if rest.startswith(line_comments):
+        line_has_comment = True
+    elif rest:
+        line_has_code = True
+
+    if line_has_comment and not line_has_code:
+        comments += 1
+
+    return LineCounts(lines - comments, comments, blank)
+
+
+def language_for(filename: str) -> Optional[Language]:
+    _, _, ext = filename.rpartition(".")
+    return LANGUAGES_BY_EXT.get(ext)
+
+
+# benchmarking
+
+_SAMPLES = {
+    PYTHON: b'''\
+import os
+
+
+def func(x: int) -> str:
+    """Some docstring.
+
+    with a couple lines.
+    """
+    # a comment
+    s = "a # string" + 'another'  # trailing comment
+    t = """not a
+    docstring"""
+    return f"{x} {s} {t}"
+''',
+    C_FAMILY: b"""\
+#include <stdio.h>
+
+/* a block
+ * comment */
+int main(int argc, char **argv) {
+    // a comment
+    const char *s = "a // string \\" with an escape";
+    char c = '\\'';
+    printf("%s %c\\n", s, c); /* trailing */
+    return 0;
+}
+""",
+    GO: b"""\
+package main
+
+import "fmt"
+
+/* a block
+   comment */
+func main() {
+	// a comment
+	s := `a raw
+string // not a comment`
+	fmt.Println(s, "x", 'y')
+}
+""",
+    JAVASCRIPT: b"""\
+const x = require("x");
+
+/**
+ * a doc comment
+ */
+function f(a, b) {
+    // a comment
+    const s = `template ${a}
+    literal // not a comment`;
+    return a / b + s.length; /* trailing */
+}
+""",
+    RUST: b"""\
+use std::fmt;
+
+/* a block /* nested */
+   comment */
+fn longest<'a>(x: &'a str, y: &'a str) -> &'a str {
+    // a comment
+    let s = "a multi
+line // string";
+    let c = '"';
+    if x.len() > y.len() { x } else { y }
+}
+""",
+}
+
+
+def benchmark(data: bytes, lang: Language, min_time: float = 1.0) -> float:
+    """Return the throughput of `count_lines` over `data`, in MB/s."""
+    runs = 0
+    start = time.perf_counter()
+
+    while (elapsed := time.perf_counter() - start) < min_time:
+        count_lines(data, lang)
+        runs += 1
+
+    return (len(data) * runs) / elapsed / 1024**2
+
+
+def main() -> int:
+    if sys.argv[1:]:  # benchmark on real files
+        for path in sys.argv[1:]:
+            if (lang := language_for(path)) is None:
+                print(f"{path}: unsupported language")
+                continue
+
+            with open(path, "rb") as f:
+                data = f.read()
+
+            print(
+                f"{path} ({lang.name}): {count_lines(data, lang)} "
+                f"@ {benchmark(data, lang):,.2f}MB/s",
+            )
+    else:  # benchmark on ~1MB of our samples
+        for lang, sample in _SAMPLES.items():
+            data = sample * ((1024**2) // len(sample))
+            print(
+                f"{lang.name}: {count_lines(sample, lang)} "
+                f"@ {benchmark(data, lang):,.2f}MB/s",
+            )
+
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,431 @@
+#!/usr/bin/env python3.10
+"""shards - run sandwich as several processes, each owning a range of shards.
+
+the supervisor starts `config.shard_processes` processes (one per core by
+default), splitting `config.shard_count` shards between them. each process
+is a full bot, with its own event loop, py workers etc, so a cpu heavy
+command only slows down the guilds on its shards. the worker pools are
+split between the processes, and each pins its benchmarks to its own core.
+
+processes report their health & stats back every so often; those which die
+are restarted (with backoff), and the merged stats are written to
+`config.stats_dump_path` if it's set.
+
+usage: python shards.py
+"""
+import asyncio
+import multiprocessing
+import os
+import signal
+import threading
+import time
+from multiprocessing.connection import Connection
+from multiprocessing.connection import wait
+from typing import Iterable
+from typing import Optional
+
+import discord
+import orjson
+from discord.ext import commands
+
+import config
+import main as sandwich
+
+
+class ShardedSandwich(sandwich.Sandwich, commands.AutoShardedBot):
+    def restart(self) -> None:
+        # we can't exec ourselves as a child; just
+        # exit, and the supervisor will start us up again.
+        os._exit(0)
+
+
+def shard_ranges(shard_count: int, processes: int) -> list[list[int]]:
+    """Split the shard ids into `processes` contiguous ranges."""
+    processes = min(processes, shard_count)
+    size, extra = divmod(shard_count, processes)
+
+    ranges = []
+    start = 0
+
+    for i in range(processes):
+        end = start + size + (i < extra)
+        ranges.append(list(range(start, end)))
+        start = end
+
+    return ranges
+
+
+def _merge(hist: sandwich.LatencyHistogram, snapshot: dict) -> None:
+    hist.counts = [a + b for a, b in zip(hist.counts, snapshot["buckets"].values())]
+    hist.count += snapshot["count"]
+    hist.total += snapshot["total"]
+    hist.max = max(hist.max, snapshot["max"])
+
+
+# point in time values, which don't carry over once a process is gone
+_GAUGES = ("in_flight", "running", "queued", "concurrency")
+
+
+def merge_stats(reports: Iterable[dict]) -> dict[str, dict]:
+    """Sum up the command, queue & message stats of several bots."""
+    histograms: dict[str, sandwich.LatencyHistogram] = {}
+    command_counts: dict[str, dict[str, int]] = {}
+    waits: dict[str, sandwich.LatencyHistogram] = {}
+    queues: dict[str, dict[str, int]] = {}
+    messages: dict[str, int] = {}
+
+    for stats in reports:
+        for name, cmd in stats["commands"].items():
+            if (hist := histograms.get(name)) is None:
+                hist = histograms[name] = sandwich.LatencyHistogram()
+                command_counts[name] = dict.fromkeys(
+                    ("errors", "cancelled", "in_flight"),
+                    0,
+                )
+
+            _merge(hist, cmd)
+            for key in command_counts[name]:
+                command_counts[name][key] += cmd[key]
+
+        for name, queue in stats.get("queues", {}).items():
+            if (hist := waits.get(name)) is None:
+                hist = waits[name] = sandwich.LatencyHistogram()
+                queues[name] = dict.fromkeys(
+                    ("running", "queued", "concurrency", "rate_limited"),
+                    0,
+                )
+
+            _merge(hist, queue["wait"])
+            for key in queues[name]:
+                queues[name][key] += queue[key]
+
+        for key, count in stats["messages"].items():
+            messages[key] = messages.get(key, 0) + count
+
+    return {
+        "commands": {
+            name: {**hist.snapshot(), **command_counts[name]}
+            for name, hist in histograms.items()
+        },
+        "queues": {
+            name: {**queues[name], "wait": hist.snapshot()}
+            for name, hist in waits.items()
+        },
+        "messages": messages,
+    }
+
+
+def _retire(stats: dict[str, dict]) -> dict[str, dict]:
+    """Zero the gauges of a dead process's stats, leaving only its counts."""
+    for group in ("commands", "queues"):
+        for counts in stats[group].values():
+            for key in _GAUGES:
+                if key in counts:
+                    counts[key] = 0
+
+    return stats
+
+
+def health(bot: ShardedSandwich) -> dict[str, object]:
+    return {
+        "pid": os.getpid(),
+        "ready": bot.is_ready(),
+        "guilds": len(bot.guilds),
+        "shards": {
+            shard_id: {
+                "latency": shard.latency,
+                "closed": shard.is_closed(),
+            }
+            for shard_id, shard in bot.shards.items()
+        },
+        "stats": bot.stats(),
+    }
+
+
+async def _report(bot: ShardedSandwich, conn: Connection, interval: float) -> None:
+    while True:
+        try:
+            conn.send(health(bot))
+        except OSError:  # the supervisor's gone; so should we be
+            os._exit(1)
+
+        await asyncio.sleep(interval)
+
+
+async def _run_shard(
+    shard_ids: list[int],
+    shard_count: int,
+    conn: Connection,
+    report_interval: float,
+) -> None:
+    # NOTE: for testing against a fake gateway
+    if (api_url := getattr(config, "discord_api_url", None)) is not None:
+        discord.http.Route.BASE = api_url
+
+    bot = ShardedSandwich(
+        command_prefix="!",
+        help_command=None,
+        shard_ids=shard_ids,
+        shard_count=shard_count,
+        **sandwich.gateway_options(),
+    )
+
+    reporter = asyncio.create_task(_report(bot, conn, report_interval))
+
+    try:
+        await bot.run(config.discord_token)
+    finally:
+        reporter.cancel()
+
+
+def run_shard(
+    shard_ids: list[int],
+    shard_count: int,
+    conn: Connection,
+    report_interval: float,
+    overrides: dict[str, object],
+) -> None:
+    """The entrypoint of a shard process."""
+    # the supervisor writes the merged stats, & each
+    # process needs its own state to carry over restarts.
+    state_path = getattr(config, "state_path", ".data/state.pickle")
+    config.state_path = f"{state_path}.{shard_ids[0]}"
+    config.stats_dump_path = None
+
+    for key, value in overrides.items():
+        setattr(config, key, value)
+
+    asyncio.run(_run_shard(shard_ids, shard_count, conn, report_interval))
+
+
+class ShardProcess:
+    def __init__(self, shard_ids: list[int]) -> None:
+        self.shard_ids = shard_ids
+
+        self.proc: Optional[multiprocessing.Process] = None
+        self.conn: Optional[Connection] = None
+
+        self.report: Optional[dict] = None
+        self.reported_at = 0.0
+
+        # the stats of its previous lives; counts restart from 0 with it
+        self.baseline: Optional[dict] = None
+
+        self.restarts = 0
+        self.failures = 0  # in a row, for backoff
+        self.restart_at: Optional[float] = None  # when dead
+
+
+class Supervisor:
+    """Runs & watches over the shard processes."""
+
+    def __init__(
+        self,
+        shard_count: int,
+        processes: int,
+        report_interval: float = 5.0,
+        max_restart_delay: float = 60.0,
+        stats_path: Optional[str] = None,
+        overrides: Optional[dict[str, object]] = None,
+    ) -> None:
+        self.shard_count = shard_count
+        self.report_interval = report_interval
+        self.max_restart_delay = max_restart_delay
+        self.stats_path = stats_path
+
+        self._mp = multiprocessing.get_context("spawn")
+        self._stopping = threading.Event()
+
+        self.shards = [
+            ShardProcess(shard_ids)
+            for shard_ids in shard_ranges(shard_count, processes)
+        ]
+
+        # each process is a full bot; split the pools sized for the
+        # whole machine between them, rather than have each build one.
+        cpus = os.cpu_count() or 1
+        processes = len(self.shards)
+
+        self.overrides = {
+            "process_pool_workers": max(
+                (getattr(config, "process_pool_workers", None) or cpus) // processes,
+                1,
+            ),
+            "py_workers": max(getattr(config, "py_workers", 2) // processes, 1),
+            **(overrides or {}),
+        }
+
+    def _start(self, shard: ShardProcess) -> None:
+        conn, child_conn = self._mp.Pipe(duplex=False)
+        shard.proc = self._mp.Process(
+            target=run_shard,
+            args=(
+                shard.shard_ids,
+                self.shard_count,
+                child_conn,
+                self.report_interval,
+                self._overrides(shard),
+            ),
+            name=f"shards {shard.shard_ids[0]}-{shard.shard_ids[-1]}",
+        )
+        shard.proc.start()
+        child_conn.close()
+
+        shard.conn = conn
+        shard.report = None
+        shard.restart_at = None
+
+    def _overrides(self, shard: ShardProcess) -> dict[str, object]:
+        if "timeit_cpu" in self.overrides:
+            return self.overrides
+
+        # benchmarks are only run one at a time within a process; give
+        # each its own core, so those of different processes don't overlap.
+        cpus = os.cpu_count() or 1
+        first_cpu = getattr(config, "timeit_cpu", None) or 0
+
+        return {
+            **self.overrides,
+            "timeit_cpu": (first_cpu + self.shards.index(shard)) % cpus,
+        }
+
+    def _died(self, shard: ShardProcess) -> None:
+        assert shard.proc is not None and shard.conn is not None
+
+        shard.proc.join()
+        shard.conn.close()
+
+        if shard.report is not None:
+            reports = filter(None, (shard.baseline, shard.report["stats"]))
+            shard.baseline = _retire(merge_stats(reports))
+            shard.report = None
+
+        # back off exponentially, in case it dies on startup
+        delay = min(2**shard.failures, self.max_restart_delay)
+        shard.restart_at = time.monotonic() + delay
+        shard.failures += 1
+
+        print(
+            f"shards {shard.shard_ids} died (exit code {shard.proc.exitcode}); "
+            f"restarting in {delay:.0f}s",
+        )
+
+    def healthy(self, shard: ShardProcess) -> bool:
+        return (
+            shard.restart_at is None
+            and shard.report is not None
+            and shard.report["ready"]
+            and time.monotonic() - shard.reported_at < self.report_interval * 3
+        )
+
+    def stats(self) -> dict[str, object]:
+        """The shards' stats merged together, along with their health."""
+        merged = merge_stats(
+            stats
+            for shard in self.shards
+            for stats in (shard.baseline, shard.report and shard.report["stats"])
+            if stats
+        )
+
+        return {
+            "time": time.time(),
+            "shard_count": self.shard_count,
+            "processes": [
+                {
+                    "shard_ids": shard.shard_ids,
+                    "pid": shard.proc.pid if shard.proc is not None else None,
+                    "healthy": self.healthy(shard),
+                    "restarts": shard.restarts,
+                    "guilds": shard.report["guilds"] if shard.report else 0,
+                    "shards": shard.report["shards"] if shard.report else {},
+                }
+                for shard in self.shards
+            ],
+            **merged,
+        }
+
+    def _dump_stats(self) -> None:
+        assert self.stats_path is not None
+
+        os.makedirs(os.path.dirname(self.stats_path) or ".", exist_ok=True)
+
+        with open(f"{self.stats_path}.tmp", "wb") as f:
+            f.write(orjson.dumps(self.stats(), option=orjson.OPT_INDENT_2))
+
+        os.replace(f"{self.stats_path}.tmp", self.stats_path)
+
+    def run(self) -> None:
+        """Start the shards, & watch over them until `stop` is called."""
+        for shard in self.shards:
+            self._start(shard)
+
+        last_dump = time.monotonic()
+
+        try:
+            while not self._stopping.is_set():
+                live = {}
+                for shard in self.shards:
+                    if shard.restart_at is None:
+                        live[shard.conn] = live[shard.proc.sentinel] = shard
+
+                for ready in wait(list(live), timeout=1.0):
+                    shard = live[ready]
+
+                    if shard.restart_at is not None:
+                        continue  # already handled its death
+
+                    if ready is shard.conn:
+                        try:
+                            shard.report = shard.conn.recv()
+                            shard.reported_at = time.monotonic()
+                            continue
+                        except EOFError:
+                            pass
+
+                    self._died(shard)
+
+                now = time.monotonic()
+
+                for shard in self.shards:
+                    if shard.restart_at is not None and now >= shard.restart_at:
+                        self._start(shard)
+                        shard.restarts += 1
+                    elif self.healthy(shard):
+                        shard.failures = 0  # it's stable again
+
+                if self.stats_path and now - last_dump >= self.report_interval:
+                    self._dump_stats()
+                    last_dump = now
+        finally:
+            for shard in self.shards:
+                if shard.proc is not None and shard.proc.is_alive():
+                    shard.proc.terminate()
+                    shard.proc.join()
+
+    def stop(self) -> None:
+        self._stopping.set()
+
+
+def main() -> int:
+    # set cwd to main directory
+    os.chdir(os.path.dirname(os.path.realpath(__file__)))
+
+    supervisor = Supervisor(
+        shard_count=getattr(config, "shard_count", os.cpu_count() or 1),
+        processes=getattr(config, "shard_processes", os.cpu_count() or 1),
+        report_interval=getattr(config, "shard_report_interval", 5.0),
+        stats_path=getattr(config, "stats_dump_path", None),
+    )
+
+    signal.signal(signal.SIGTERM, lambda *_: supervisor.stop())
+
+    try:
+        supervisor.run()
+    except KeyboardInterrupt:
+        pass
+
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,139 @@
+"""sp500 - a fast S&P 500 investment scenario engine, for !py's sp500_analysis.
+
+the monthly index & inflation (cpi) series are loaded once into numpy arrays,
+along with a running sum of each month's inverse price. a scenario's ending
+balance is then a handful of lookups, however long it spans:
+
+    balance = start_balance * P[end] / P[start]
+            + contribution * P[end] * (sum of 1 / P[k] for start < k <= end)
+
+and a whole grid of scenarios is a single broadcast over those arrays.
+
+the series is read from a csv of `date,price,cpi` rows (date as YYYY-MM or
+YYYY-MM-DD), one per month; use a total return series for the price to
+account for reinvested dividends.
+"""
+import csv
+import datetime
+import functools
+from typing import Sequence
+
+import numpy as np
+
+
+class Scenarios:
+    def __init__(
+        self,
+        first_month: datetime.date,
+        prices: np.ndarray,
+        cpi: np.ndarray,
+    ) -> None:
+        self.first_month = first_month.replace(day=1)
+        self.prices = prices
+        self.cpi = cpi
+
+        # inv_cumsum[k] = sum of 1 / prices[j] for j <= k
+        self.inv_cumsum = np.cumsum(1 / prices)
+
+        # memoize single scenarios; !py users tend to repeat themselves
+        self.real_balance = functools.lru_cache(maxsize=4096)(self.real_balance)
+
+    @classmethod
+    def from_csv(cls, path: str) -> "Scenarios":
+        with open(path, newline="") as f:
+            rows = [row for row in csv.DictReader(f)]
+
+        months = [datetime.date.fromisoformat(f"{row['date'][:7]}-01") for row in rows]
+
+        for prev, month in zip(months, months[1:]):
+            if (month.year - prev.year) * 12 + month.month - prev.month != 1:
+                raise ValueError(f"{path}: {month} doesn't follow {prev}.")
+
+        return cls(
+            first_month=months[0],
+            prices=np.array([float(row["price"]) for row in rows]),
+            cpi=np.array([float(row["cpi"]) for row in rows]),
+        )
+
+    def month_index(self, date: datetime.date) -> int:
+        index = (date.year - self.first_month.year) * 12 + (
+            date.month - self.first_month.month
+        )
+
+        if not 0 <= index < len(self.prices):
+            raise ValueError(f"No data for {date:%Y-%m}.")
+
+        return index
+
+    def _month_indices(self, dates: Sequence[datetime.date]) -> np.ndarray:
+        return np.array([self.month_index(date) for date in dates])
+
+    def balance(
+        self,
+        start_date: datetime.date,
+        end_date: datetime.date,
+        starting_balance: float,
+        monthly_contributions: float,
+    ) -> tuple[float, float]:
+        """The nominal ending balance of a scenario, & the inflation over it."""
+        start = self.month_index(start_date)
+        end = self.month_index(end_date)
+
+        if end < start:
+            raise ValueError("The end date must not be before the start date.")
+
+        growth = self.prices[end] / self.prices[start]
+        contributed = self.prices[end] * (self.inv_cumsum[end] - self.inv_cumsum[start])
+
+        return (
+            float(starting_balance * growth + monthly_contributions * contributed),
+            float(self.cpi[end] / self.cpi[start]),
+        )
+
+    def real_balance(
+        self,
+        start_date: datetime.date,
+        end_date: datetime.date,
+        starting_balance: float,
+        monthly_contributions: float,
+    ) -> float:
+        """The ending balance of a scenario, in start date dollars."""
+        balance, inflation = self.balance(
+            start_date,
+            end_date,
+            starting_balance,
+            monthly_contributions,
+        )
+        return balance / inflation
+
+    def grid(
+        self,
+        start_dates: Sequence[datetime.date],
+        end_dates: Sequence[datetime.date],
+        starting_balances: Sequence[float],
+        monthly_contributions: Sequence[float],
+    ) -> np.ndarray:
+        """Real ending balances for every combination of the parameters.
+
+        The result has shape (starts, ends, balances, contributions);
+        combinations which end before they start are nan.
+        """
+        start = self._month_indices(start_dates)[:, None, None, None]
+        end = self._month_indices(end_dates)[None, :, None, None]
+        balances = np.asarray(starting_balances, dtype=float)[None, None, :, None]
+        contributions = np.asarray(monthly_contributions, dtype=float)[
+            None, None, None, :
+        ]
+
+        growth = self.prices[end] / self.prices[start]
+        contributed = self.prices[end] * (self.inv_cumsum[end] - self.inv_cumsum[start])
+        inflation = self.cpi[end] / self.cpi[start]
+
+        real = (balances * growth + contributions * contributed) / inflation
+        return np.where(end >= start, real, np.nan)
+
+
+@functools.lru_cache(maxsize=None)
+def load(path: str) -> Scenarios:
+    """Load (only once) the scenarios for a series."""
+    return Scenarios.from_csv(path)